@@ -6,6 +6,7 @@ from enum import Enum
 from typing import Dict, List
 import webcolors
 import yaml
+from task_queue import TaskQueue
 
 def load_yaml():
     with open('zones_config.yaml', 'r') as file:
@@ -17,7 +18,7 @@ ROBOTS={}
 TRANSITS=[]
 ZONE_PHASE ={}
 VIAL_TYPE ={}
-tasks_q={}
+tasks_q:Dict[int, TaskQueue]={}
 
 class TaskType(Enum):
     LOAD = 1
@@ -29,6 +30,11 @@ class TaskType(Enum):
     PAUSE= 7
     INIT=8
 
+class VialState(Enum):
+    ACTIVE = 1
+    ARCHIVED = 2 # in a stateful zone
+    DISPOSED = 3 # left the system, no longer kept by the vial manager
+
 class ItemType(Enum):
     VIAL = 1
     ZONE = 2
@@ -73,6 +79,17 @@ class ZoneTransition:
         self.disposable =data.get('disposable', False)
         self.zone_type =data.get('zone_type',None)
         self.control_process_check =data.get('control_process_check', False)
+        # filters compiled for matching items and vials
+        self.color_set =frozenset(self.colors)
+        self.type_set =frozenset(self.types)
+        self.transit_set =frozenset(self.transits)
+        self.check_disposal =self.disposable is not False
+        # resolved (function, is_async) chains of the hooks above, set by the zone manager
+        self.pre_checks_chain =None
+        self.pre_operations_chain =None
+        self.pre_tasks_chain =None
+        self.post_operations_chain =None
+        self.time_dependent =False # a hook depends on the time, re-evaluated on every call
         
 class AppData:
     def __init__(self):
@@ -106,6 +123,8 @@ class AppData:
         self.error_codes = app_data.get('error_codes',None)
         self.color_transit_map = app_data.get('color_transit_map',None)  
         self.sensors={}
+        self.sensors_version:int =0 # bumped on every sensor change
+        self.change_listener=None # called on every sensor change, set by the zone manager
         self.sftp_host = app_data.get('sftp_host',None)
         self.sftp_port = app_data.get('sftp_port',None) 
         self.sftp_user = app_data.get('sftp_user',None) 
@@ -119,6 +138,22 @@ class AppData:
         self.color_zone_map = app_data.get('color_zone_map',None)  
         self.zone_controls_map = {entry["rackzone"]: entry for entry in app_data.get('zone_controls_map',None)}
         self.controls_time= datetime.strptime("05:00", "%H:%M").time()
+        self.lookahead_planning:bool = bool(app_data.get('lookahead_planning',0))
+        self.lookahead_timeout:float = app_data.get('lookahead_timeout',60)
+        self.debug_zone_counters:bool = bool(app_data.get('debug_zone_counters',0))
+        self.vial_history:bool = bool(app_data.get('vial_history',0))
+        self.state_journal:bool = bool(app_data.get('state_journal',1))
+        self.journal_max_size:int = app_data.get('journal_max_size',1048576)
+        self.snapshot_interval:int = app_data.get('snapshot_interval',3600)
+        self.snapshot_debounce:float = app_data.get('snapshot_debounce',1)
+        self.future_ttl:int = app_data.get('future_ttl',86400)
+        self.snapshot_format:str = app_data.get('snapshot_format','json')
+        self.zone_events:bool = bool(app_data.get('zone_events',1))
+        self.event_buffer_size:int = app_data.get('event_buffer_size',10000)
+        self.task_wait_timeout:float = app_data.get('task_wait_timeout',30)
+        self.task_wait_recheck:float = app_data.get('task_wait_recheck',5)
+        if self.snapshot_format not in ('json','binary'):
+            raise ValueError(f"Unknown snapshot_format: {self.snapshot_format}")
 
  
         self.reset() 
@@ -133,7 +168,7 @@ class AppData:
 
         for name, value in app_data['robots'].items():
             ROBOTS[name]=value
-            tasks_q[name]=[]
+            tasks_q[name]=TaskQueue()
         
         TRANSITS=app_data['transits']
 
@@ -141,11 +176,23 @@ class AppData:
             VIAL_TYPE[name]=value
     
     def reset(self):    
-        self.cam1_sensor:bool =True
+        self.set_cam1_sensor(True)
         if self.zone_locks:
             self.zone_locks.clear()
         self.popup_acknowledged =True
 
+    def set_sensor(self,id:int,val):
+        self.sensors[id]=val
+        self.sensors_version +=1
+        if self.change_listener:
+            self.change_listener()
+
+    def set_cam1_sensor(self,val:bool):
+        self.cam1_sensor:bool =val
+        self.sensors_version +=1
+        if self.change_listener:
+            self.change_listener()
+
 app_data:AppData=AppData()
 
 @dataclass
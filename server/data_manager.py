@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 from typing import Any
@@ -7,8 +8,22 @@ from event_tracker import tasks_auditor,error_auditor
 
 async def write_to_file(data: Any, file_name: str = "zones.json") -> bool:
     try:
-        async with aiofiles.open(file_name, 'w') as file: 
-            await file.write(json.dumps(data, indent=4)) 
+        # serialized off the event loop
+        raw_data = data if isinstance(data, bytes) else await asyncio.to_thread(json.dumps, data, indent=4)
+        return await write_raw_to_file(raw_data, file_name)
+    except Exception as e:
+        error_auditor.error(f"Error writing to {file_name}: {e}")
+        return False
+
+async def write_raw_to_file(raw_data: Any, file_name: str) -> bool:
+    try:
+        # written to a temp file and renamed so a crash leaves the old file intact
+        temp_name = file_name + ".tmp"
+        async with aiofiles.open(temp_name, 'wb' if isinstance(raw_data, bytes) else 'w') as file: 
+            await file.write(raw_data) 
+            await file.flush()
+            await asyncio.to_thread(os.fsync, file.fileno())
+        os.replace(temp_name, file_name)
         tasks_auditor.info(
                 f"Write: Latest data sent to file: {file_name}")
         return True
@@ -28,3 +43,15 @@ async def read_from_file(file_name: str = "zones.json") -> Any:
     except Exception as e:
         error_auditor.error(f"Error reading from {file_name}: {e}")
         return None
+
+async def read_bytes_from_file(file_name: str) -> bytes:
+    try:
+        async with aiofiles.open(file_name, 'rb') as file:
+            raw_data = await file.read()
+        if raw_data:
+            tasks_auditor.info(f"Read: Latest data loaded from file: {file_name}")
+            return raw_data
+        return None
+    except Exception as e:
+        error_auditor.error(f"Error reading from {file_name}: {e}")
+        return None
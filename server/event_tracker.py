@@ -27,6 +27,7 @@ class EventTracker:
         self.auditors['pallet'] = self._create_logger('pallet', log_level)
         self.auditors['errors'] = self._create_logger('errors', log_level)
         self.auditors['linfosys'] = self._create_logger('linfosys', log_level)
+        self.auditors['vials'] = self._create_logger('vials', log_level)
 
     def _create_logger(self, name: str, log_level: int) -> logging.Logger:
         """
@@ -61,3 +62,4 @@ pallet_auditor = event_tracker.get_auditor('pallet')
 tasks_auditor = event_tracker.get_auditor('tasks')
 error_auditor = event_tracker.get_auditor('errors')
 linfosys_auditor = event_tracker.get_auditor('linfosys')
+vials_auditor = event_tracker.get_auditor('vials')
@@ -1,30 +1,174 @@
-import asyncio
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
 import inspect
-from random import randint
+import time
 from typing import Callable, Dict, List
-from event_tracker import tasks_auditor
+from configuration import app_data
+from event_tracker import tasks_auditor,error_auditor
+from state_journal import state_writer
+
+@dataclass
+class FutureCommand:
+    """
+    A state change applied when the robot reports the task, e.g. move the vial at an item to another item.
+    Commands only hold ids and positions, so pending futures can be journaled and replayed after a restart.
+    """
+    name: str
+    args: dict = field(default_factory=dict)
 
 @dataclass
 class FuturesManager:
-    
-    futures: Dict[int, List[Callable]] = field(default_factory=dict) 
 
-    def register_future(self,random_id:int, tasks):
-        self.futures[random_id] = tasks
+    futures: Dict[int, List[FutureCommand]] = field(default_factory=dict)
+    executed_count: int = 0
+    handlers: Dict[str, Callable] = field(default_factory=dict) # command name: handler, registered by the zone manager
+    restored: set = field(default_factory=set) # random ids read from the journal at the last import
+    new_records: Dict[int, dict] = field(default_factory=dict) # futures not journaled yet
+    done_records: List[dict] = field(default_factory=list) # completions and discards not journaled yet
+    created: Dict[int, float] = field(default_factory=dict) # random id: monotonic time it was registered, oldest first
+    last_id: int = 0
+    expired_count: int = 0
+    discarded_count: int = 0
+    replaying: bool = False # set while a future read from the journal is executed
+
+    def next_id(self) -> int:
+        # increasing and never below the clock, the last id is journaled, so the ids of an earlier run are not handed out again
+        self.last_id = max(self.last_id + 1, int(time.time()))
+        return self.last_id
+
+    def register_handler(self, name: str, handler: Callable):
+        self.handlers[name] = handler
+
+    def register_future(self,random_id:int, commands:List[FutureCommand]):
+        unknown=[command.name for command in commands if command.name not in self.handlers]
+        if unknown:
+            raise ValueError(f"Unknown future commands: {unknown}")
+        self.expire_futures()
+        self.futures[random_id] = commands
+        self.created[random_id] = time.monotonic()
+        self.new_records[random_id] = {"future_id": random_id, "commands": [asdict(command) for command in commands]}
+
+    def remove_future(self, random_id: int):
+        self.restored.discard(random_id)
+        self.created.pop(random_id, None)
+        # a future never journaled needs no completion record
+        if self.new_records.pop(random_id, None) is None:
+            self.done_records.append({"future_id": random_id})
+        return self.futures.pop(random_id)
+
+    def restore_future(self, random_id: int, commands: List[FutureCommand]):
+        # pending again after its changes were undone, e.g. a lookahead the robot did not confirm
+        done = {"future_id": random_id}
+        if done in self.done_records:
+            self.done_records.remove(done)
+        else:
+            self.new_records[random_id] = {"future_id": random_id, "commands": [asdict(command) for command in commands]}
+        self.futures[random_id] = commands
+        self.created[random_id] = time.monotonic()
+        self.executed_count -=1
+
+    def discard_future(self, random_id: int):
+        if random_id in self.futures:
+            self.remove_future(random_id)
+            self.discarded_count +=1
+            tasks_auditor.info(f"Futures discarded for random id:{random_id}")
+
+    def discard_all(self, restored_only=False):
+        random_ids = list(self.restored if restored_only else self.futures)
+        for random_id in random_ids:
+            self.remove_future(random_id)
+        self.discarded_count += len(random_ids)
+        if random_ids:
+            tasks_auditor.info(f"Futures discarded for random ids:{random_ids}")
+        return len(random_ids)
+
+    def expire_futures(self):
+        # the robot never reported these ids, e.g. a task lost with a robot restart
+        if not app_data.future_ttl:
+            return
+        now = time.monotonic()
+        while self.created:
+            random_id, created = next(iter(self.created.items()))
+            if now - created < app_data.future_ttl:
+                break
+            commands = self.remove_future(random_id)
+            self.expired_count +=1
+            tasks_auditor.warning(f"Futures expired for random id:{random_id} after {now - created:.0f}s: {[asdict(command) for command in commands]}")
 
     async def execute_future(self, random_id: int):
         if random_id not in self.futures:
             return
-        tasks=self.futures[random_id] 
-        for task in tasks:
-            if not task:
-                continue
-            if inspect.iscoroutinefunction(task):
-                await task() 
-            else:
-                task()
-        tasks_auditor.info(f"Futures completed for random id:{random_id}")
-        del self.futures[random_id]
+        restored = random_id in self.restored
+        commands=self.remove_future(random_id)
+        self.replaying = restored
+        try:
+            for command in commands:
+                handler=self.handlers[command.name]
+                if inspect.iscoroutinefunction(handler):
+                    result=await handler(**command.args)
+                else:
+                    result=handler(**command.args)
+                # a check failed, the state does not match the task any more
+                if result is False:
+                    error_auditor.error(f"Futures stopped at {command.name} for random id:{random_id}")
+                    break
+        finally:
+            self.replaying = False
+        self.executed_count +=1
+        tasks_auditor.info(f"Futures completed for random id:{random_id}{' (restored)' if restored else ''}")
+        # journaled with the next write even when no persisted zone changed, it is not replayed after a restart
+        if self.done_records and app_data.state_journal:
+            state_writer.mark_dirty()
+
+    def take_records(self, done=True) -> list:
+        """
+        Journal records of the new futures, and of the completions if done is set.
+        Completions are written with the zone changes they caused, so a crash never drops one without the other.
+        """
+        records = list(self.new_records.values())
+        self.new_records.clear()
+        if done:
+            records.extend(self.done_records)
+            self.done_records.clear()
+        return records
+
+    def get_pending_records(self) -> list:
+        # the pending futures, carried over into the journal of a new snapshot
+        self.new_records.clear()
+        self.done_records.clear()
+        # the ids of the completed futures are dropped with the old journal, the last one is kept
+        return [{"last_future_id": self.last_id}]+[{"future_id": random_id, "commands": [asdict(command) for command in commands]}
+                for random_id, commands in self.futures.items()]
+
+    def import_record(self, record: dict):
+        if "last_future_id" in record:
+            self.last_id = max(self.last_id, record["last_future_id"])
+            return
+        random_id = record["future_id"]
+        self.last_id = max(self.last_id, random_id)
+        if "commands" in record:
+            self.futures[random_id] = [FutureCommand(**command) for command in record["commands"]]
+            self.created[random_id] = time.monotonic()
+            self.restored.add(random_id)
+        else:
+            self.futures.pop(random_id, None)
+            self.created.pop(random_id, None)
+            self.restored.discard(random_id)
+
+    def get_stats(self):
+        now = time.monotonic()
+        ages = [now - created for created in self.created.values()]
+        buckets = {"<1m": 60, "<10m": 600, "<1h": 3600, "<1d": 86400}
+        age_buckets = {name: sum(1 for age in ages if age < limit) for name, limit in buckets.items()}
+        age_buckets[">=1d"] = sum(1 for age in ages if age >= 86400)
+        return {
+            "pending": len(self.futures),
+            "restored": len(self.restored),
+            "oldest_age": round(max(ages, default=0.0), 3),
+            "age_buckets": age_buckets,
+            "executed": self.executed_count,
+            "discarded": self.discarded_count,
+            "expired": self.expired_count,
+            "last_id": self.last_id,
+        }
 
 futures_manager = FuturesManager()
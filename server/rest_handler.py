@@ -1,9 +1,12 @@
 
-from aiohttp import web
+import asyncio
+from aiohttp import web, WSMsgType
 from rpc_handler import GlobalHandler
 from utils import acquire_zone_lock, release_zone_lock
 from configuration import app_data
 from event_tracker import tasks_auditor,error_auditor
+from zone_events import zone_events
+from zone_manager import zone_manager
 
 # REST API Handlers
 async def restart(request):
@@ -17,7 +20,8 @@ async def get_task(request):
         content=request.query
     random_id = content.get('random_id')
     robot_id = content.get('robot_id')
-    task = await GlobalHandler.rpc_get_task(GlobalHandler,int(random_id),int(robot_id))
+    wait = content.get('wait',0)
+    task = await GlobalHandler.rpc_get_task(GlobalHandler,int(random_id),int(robot_id),float(wait))
     return web.json_response(task)
 
 async def update_camera2_result(request):
@@ -33,7 +37,7 @@ async def set_camera_flag(request):
     """
     try:
         tasks_auditor.info(f"Set camera flag command recieved")   
-        app_data.cam1_sensor=True
+        app_data.set_cam1_sensor(True)
         return web.json_response({"result": True})
     except Exception as e:
         return web.json_response({"error": str(e)}, status=400)
@@ -45,7 +49,7 @@ async def set_sensor_flag(request):
     try:
         command = await request.json()
         tasks_auditor.info(f"Set sensor command recieved: {command}")   
-        app_data.sensors[int(command['id'])]= command['val'] 
+        app_data.set_sensor(int(command['id']),command['val'])
         return web.json_response({"result": True})
     except Exception as e:
         return web.json_response({"error": str(e)}, status=400) 
@@ -201,6 +205,52 @@ async def init_vial(request={}):
     task = await GlobalHandler.rpc_init_vial(GlobalHandler,bool(is_present),str(random_id))
     return web.Response(text= task)
     
+async def batch(request):
+    operations = await request.json()
+    return web.json_response(await GlobalHandler.rpc_batch(GlobalHandler,operations))
+
+async def get_archiv_data(request):
+    await GlobalHandler.load_file(GlobalHandler)
+    return await get_versioned_data(request,True)
+
+async def get_data(request):
+    return await get_versioned_data(request,False)
+
+async def get_versioned_data(request,archiv:bool):
+    """
+        Zone data with an ETag, unchanged data is answered with 304 and no body
+    """
+    etag = zone_manager.get_etag(archiv)
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers={"ETag": etag})
+    return web.Response(body=zone_manager.get_encoded_data(archiv), content_type="application/json", headers={"ETag": etag})
+
+async def stream_zone_events(request):
+    """
+        WebSocket streaming the zone changes. A client passes ?since=<seq> to resume after the last event it saw
+    """
+    since = request.query.get('since')
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    queue = zone_events.subscribe(int(since) if since else None)
+    sender = asyncio.create_task(send_zone_events(ws, queue))
+    try:
+        # the client only listens, reading notices when it goes away
+        async for msg in ws:
+            if msg.type == WSMsgType.ERROR:
+                break
+    finally:
+        sender.cancel()
+        zone_events.unsubscribe(queue)
+    return ws
+
+async def send_zone_events(ws:web.WebSocketResponse, queue:asyncio.Queue):
+    try:
+        while not ws.closed:
+            await ws.send_str(await queue.get())
+    except ConnectionResetError as e:
+        error_auditor.error(f"Zone events client disconnected: {e}")
+
 def add_rest_routes(app:web.Application):
     app.router.add_post('/restart', restart)
     app.router.add_get('/get_task', get_task)
@@ -222,4 +272,8 @@ def add_rest_routes(app:web.Application):
     app.router.add_post('/popup_acknowledged', set_popup_acknowledged)
     app.router.add_post('/bin_cleared', bin_cleared)
     app.router.add_post('/test', test)
-    app.router.add_post('/init_vial',init_vial)
\ No newline at end of file
+    app.router.add_post('/init_vial',init_vial)
+    app.router.add_get('/zone_events',stream_zone_events)
+    app.router.add_get('/archiv_data',get_archiv_data)
+    app.router.add_get('/data',get_data)
+    app.router.add_post('/batch',batch)
\ No newline at end of file
@@ -1,19 +1,33 @@
 import asyncio
 from datetime import datetime
 from aiohttp_xmlrpc import handler
+from aiohttp_xmlrpc.handler import rename
 from futures_manager import futures_manager
 from utils import acquire_zone_lock, release_zone_lock
 from waypoints_manager import waypoints_manager
 from zone_manager import zone_manager
-from configuration import app_data, VIAL_TYPE, COLORS, TRANSITS, ZonePhase
+from configuration import app_data, VIAL_TYPE, COLORS, TRANSITS, ZonePhase, tasks_q
 from vial_manager import vial_manager
-from event_tracker import tasks_auditor
+from state_journal import state_journal, state_writer
+from zone_events import zone_events
+from event_tracker import tasks_auditor, error_auditor
 from random import choice
 
+# operations of a batch call and the rpc methods applying them
+BATCH_OPERATIONS = {
+    "execute_future": "rpc_execute_future",
+    "camera2_result": "rpc_update_camera2_result",
+    "camera14_result": "rpc_update_camera14_result",
+    "init_vial": "rpc_init_vial",
+    "set_sensor": "rpc_set_sensor_flag",
+    "get_task": "rpc_get_task",
+}
+
 class GlobalHandler(handler.XMLRPCView):
     async def rpc_restart(self,archiv_reset=True):
         try:
-            vial_manager.restart()        
+            await zone_manager.discard_futures()
+            vial_manager.restart(archiv_reset)
             await zone_manager.restart(archiv_reset)
             waypoints_manager.restart()
             app_data.reset()
@@ -25,7 +39,7 @@ class GlobalHandler(handler.XMLRPCView):
             print(e)
     
     async def refresh_data(self,archiv_reset=False):
-        vial_manager.restart()        
+        vial_manager.restart(archiv_reset)
         await zone_manager.restart(archiv_reset)
         waypoints_manager.restart()
         app_data.reset()
@@ -33,9 +47,12 @@ class GlobalHandler(handler.XMLRPCView):
     async def rpc_task(self): 
         return 1
 
-    async def rpc_get_task(self,random_id,robot_id):
+    async def rpc_get_task(self,random_id,robot_id,wait=0):
+        # with wait, an idle robot gets its next task as soon as there is one, within wait seconds
+        await zone_manager.check_lookahead(random_id,robot_id)
         await futures_manager.execute_future(random_id)
-        task= await zone_manager.get_task(robot_id)
+        task= await zone_manager.wait_task(robot_id,wait) if wait else await zone_manager.get_task(robot_id)
+        zone_manager.start_lookahead(task,robot_id)
         
         # Print task response in human-readable format
         print("\n" + "="*60)
@@ -51,16 +68,39 @@ class GlobalHandler(handler.XMLRPCView):
         
         return task
     
+    async def rpc_get_task_queues(self):
+        return {str(robot_id): queue.get_stats() for robot_id, queue in tasks_q.items()}
+
+    async def rpc_get_vial_stats(self):
+        return vial_manager.get_stats()
+
+    async def rpc_get_persistence_stats(self):
+        return {**state_writer.get_stats(), **state_journal.get_stats(), "state_loaded": zone_manager.state_loaded,
+                "restore_timings": {str(zone_id): ms for zone_id, ms in zone_manager.restore_timings.items()}}
+
+    async def rpc_get_futures_stats(self):
+        return futures_manager.get_stats()
+
+    async def rpc_get_event_stats(self):
+        return zone_events.get_stats()
+
+    async def rpc_discard_futures(self):
+        # drops the futures restored after a restart when the robot will not report them
+        return await zone_manager.discard_futures(True)
+    
     async def rpc_update_camera2_result(self,is_success,type,random_id):
+        await zone_manager.discard_lookaheads()
         await futures_manager.execute_future(random_id)
         await zone_manager.update_camera2_result_test_1006(bool(is_success),None)
         return
         
     async def rpc_update_camera14_result(self,is_present,random_id):
+        await zone_manager.discard_lookaheads()
         await futures_manager.execute_future(random_id)
         return await zone_manager.update_camera14_result(is_present)
 
     async def rpc_init_vial(self,is_present,random_id):
+        await zone_manager.discard_lookaheads()
         await futures_manager.execute_future(random_id)
         return await zone_manager.init_vial(is_present)
 
@@ -74,12 +114,53 @@ class GlobalHandler(handler.XMLRPCView):
         return await waypoints_manager.register_waypoints(points,zone_id,subzone_id,type,robot_id)
     
     async def rpc_execute_future(self,random_id):
+        await zone_manager.discard_lookaheads()
         await futures_manager.execute_future(random_id)
+
+    async def rpc_set_sensor_flag(self,id,val):
+        tasks_auditor.info(f"Set sensor command recieved: {id}: {val}")
+        app_data.set_sensor(int(id),val)
+        return True
+
+    async def rpc_batch(self,operations):
+        """
+        Applies the operations in order in one call, e.g. [{"op": "execute_future", "random_id": 1}, {"op": "get_task", ...}].
+        Returns a result per operation. The first failing operation gets {"error": message} and the rest are not applied.
+        """
+        results=[]
+        for operation in operations:
+            operation=dict(operation)
+            name=operation.pop("op",None)
+            try:
+                if name not in BATCH_OPERATIONS:
+                    raise ValueError(f"Unknown batch operation: {name}")
+                results.append(await getattr(GlobalHandler,BATCH_OPERATIONS[name])(self,**operation))
+            except Exception as e:
+                error_auditor.error(f"Batch operation {name} failed: {e}")
+                results.append({"error": str(e)})
+                break
+        return results
+
+    @rename("system.multicall")
+    async def rpc_system_multicall(self,calls):
+        # standard XML-RPC multicall, a fault of one call does not stop the others
+        results=[]
+        for call in calls:
+            try:
+                if call["methodName"] == "system.multicall":
+                    raise ValueError("system.multicall can not be nested")
+                method=self._lookup_method(call["methodName"])
+                results.append([await method(*call.get("params",[]))])
+            except Exception as e:
+                error_auditor.error(f"Multicall {call.get('methodName')} failed: {e}")
+                results.append({"faultCode": -32500, "faultString": f"{type(e).__name__}: {e}"})
+        return results
     
     async def rpc_set_centri_runtime(self):
         await zone_manager.set_centri_run_time()
 
     async def rpc_update_camera2_result_test(self,is_success,type,random_id,appId):
+        await zone_manager.discard_lookaheads()
         await futures_manager.execute_future(random_id)
         if appId == 1001:
             await zone_manager.update_camera2_result_test_1001(is_success,type)
@@ -93,14 +174,22 @@ class GlobalHandler(handler.XMLRPCView):
             await zone_manager.update_camera2_result_test_1006(is_success,type)
         return
     
-    async def rpc_get_archiv_data(self):
+    async def load_file(self):
         if not zone_manager.file_loaded:
-            await self.refresh_data(False)
+            await GlobalHandler.refresh_data(GlobalHandler,False)
             tasks_auditor.info("Data got refreshed as file is not loaded.")
             zone_manager.file_loaded=True
+
+    async def rpc_get_archiv_data(self):
+        await GlobalHandler.load_file(self)
         data=await zone_manager.get_archiv_data()
         print(data)
         return data
+
+    async def rpc_get_archiv_data_since(self,since_version,epoch=None):
+        # only the archives changed after since_version, with the version to pass next time
+        await GlobalHandler.load_file(self)
+        return await zone_manager.get_changed_data(True,since_version,epoch)
     
     async def rpc_get_order(self):
         order = {
@@ -112,6 +201,9 @@ class GlobalHandler(handler.XMLRPCView):
     async def rpc_get_data(self):
         data=await zone_manager.get_data()
         return data
+
+    async def rpc_get_data_since(self,since_version,epoch=None):
+        return await zone_manager.get_changed_data(False,since_version,epoch)
     
     async def rpc_delete_vial_by_barcode(self,data):
         for barcode in data['barcodes']:
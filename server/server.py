@@ -4,8 +4,13 @@ from event_tracker import tasks_auditor
 from rpc_handler import GlobalHandler
 from configuration import app_data
 from rest_handler import add_rest_routes
+from state_journal import state_writer
+from zone_manager import zone_manager
 
 async def shutdown(app):
+    # moves applied ahead are not confirmed by the robot any more
+    await zone_manager.discard_lookaheads()
+    await state_writer.flush()
     tasks_auditor.info("Server terminated Successfully") 
 
 app = web.Application(middlewares=[cors_middleware])
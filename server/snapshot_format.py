@@ -0,0 +1,179 @@
+import json
+import struct
+from dataclasses import fields
+from vial import Vial
+
+# Binary snapshot of the stateful zones
+#   header: magic, format version
+#   string table: line codes, transits, added times and other strings, each stored once
+#   zones: zone id, phase, door, zone type, items and subzones, nested like Zone.export_data
+# Vials with fields of unexpected types are stored as their JSON instead.
+
+MAGIC = b"DBZS"
+VERSION = 1
+NONE_INT = -2**31
+NONE_INDEX = 2**32-1
+NONE_BOOL = 2
+
+HEADER = struct.Struct("<4sH")
+COUNT = struct.Struct("<I")
+ZONE = struct.Struct("<iBBiHH") # zone id, phase, door opened, zone type, items, subzones
+ITEM = struct.Struct("<iB") # position, packed or json
+VIAL = struct.Struct("<I5i6BIIBB") # line code, color, type, current zone, current subzone, next zone,
+                                   # fluid level, centrifuged, decapped, to centrifuge, to decap, emergency,
+                                   # archive type, added time, transits count, blood bags count
+INDEX = struct.Struct("<I")
+
+VIAL_FIELDS = frozenset(field.name for field in fields(Vial))
+PACKED, JSON = 0, 1
+
+class SnapshotError(ValueError):
+    pass
+
+class StringTable:
+    def __init__(self):
+        self.strings: list[str] = []
+        self.indexes: dict[str, int] = {}
+
+    def index(self, value):
+        if value is None:
+            return NONE_INDEX
+        index = self.indexes.get(value)
+        if index is None:
+            index = self.indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+def is_int(value):
+    return value is None or (isinstance(value, int) and not isinstance(value, bool) and NONE_INT < value < 2**31)
+
+def is_bool(value):
+    return value is None or isinstance(value, bool)
+
+def is_strings(values):
+    return isinstance(values, list) and len(values) < 256 and all(isinstance(value, str) for value in values)
+
+def can_pack(vial: Vial):
+    return (vial.__dict__.keys() == VIAL_FIELDS and isinstance(vial.line_code, str) and
+            all(is_int(value) for value in (vial.color, vial.type, vial.current_zone_id, vial.current_subzone_id, vial.next_zone_id)) and
+            all(is_bool(value) for value in (vial.fluid_level, vial.centrifuged, vial.decapped, vial.to_centrifuge, vial.to_decap, vial.emergency)) and
+            (vial.archive_type is None or isinstance(vial.archive_type, str)) and
+            (vial.added_time is None or isinstance(vial.added_time, str)) and
+            is_strings(vial.transits) and is_strings(vial.blood_bags))
+
+def pack_int(value):
+    return NONE_INT if value is None else value
+
+def pack_bool(value):
+    return NONE_BOOL if value is None else int(value)
+
+def pack_vial(vial: Vial, strings: StringTable, out: list):
+    out.append(VIAL.pack(strings.index(vial.line_code),
+                         pack_int(vial.color), pack_int(vial.type), pack_int(vial.current_zone_id),
+                         pack_int(vial.current_subzone_id), pack_int(vial.next_zone_id),
+                         pack_bool(vial.fluid_level), pack_bool(vial.centrifuged), pack_bool(vial.decapped),
+                         pack_bool(vial.to_centrifuge), pack_bool(vial.to_decap), pack_bool(vial.emergency),
+                         strings.index(vial.archive_type), strings.index(vial.added_time),
+                         len(vial.transits), len(vial.blood_bags)))
+    for value in vial.transits + vial.blood_bags:
+        out.append(INDEX.pack(strings.index(value)))
+
+def pack_zone(zone_id, zone, strings: StringTable, out: list):
+    items = [item for item in zone.zone_items if item.content]
+    out.append(ZONE.pack(zone_id, zone.phase.value, int(zone.door_opened), pack_int(zone.zone_type), len(items), len(zone.subzones)))
+    for item in items:
+        if can_pack(item.content):
+            out.append(ITEM.pack(item.position, PACKED))
+            pack_vial(item.content, strings, out)
+        else:
+            out.append(ITEM.pack(item.position, JSON))
+            out.append(INDEX.pack(strings.index(item.content.export_data(False))))
+    for subzone in zone.subzones:
+        pack_zone(subzone.zone_id, subzone, strings, out)
+
+def encode_snapshot(zones) -> bytes:
+    """
+    Packs the (zone id, zone) pairs. Runs on the event loop, so the zones can not change while they are packed.
+    """
+    strings = StringTable()
+    body = [COUNT.pack(len(zones))]
+    for zone_id, zone in zones:
+        pack_zone(zone_id, zone, strings, body)
+    head = [HEADER.pack(MAGIC, VERSION), COUNT.pack(len(strings.strings))]
+    for value in strings.strings:
+        encoded = value.encode('utf-8')
+        head.append(COUNT.pack(len(encoded)))
+        head.append(encoded)
+    return b"".join(head + body)
+
+class Reader:
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self.offset = 0
+
+    def read(self, layout: struct.Struct):
+        values = layout.unpack_from(self.raw, self.offset)
+        self.offset += layout.size
+        return values
+
+    def read_bytes(self, size):
+        value = self.raw[self.offset:self.offset+size]
+        if len(value) != size:
+            raise SnapshotError("snapshot is truncated")
+        self.offset += size
+        return value
+
+def unpack_int(value):
+    return None if value == NONE_INT else value
+
+def unpack_bool(value):
+    return None if value == NONE_BOOL else bool(value)
+
+def unpack_vial(reader: Reader, strings: list) -> Vial:
+    (line_code, color, type, current_zone_id, current_subzone_id, next_zone_id,
+     fluid_level, centrifuged, decapped, to_centrifuge, to_decap, emergency,
+     archive_type, added_time, transits_count, bags_count) = reader.read(VIAL)
+    values = [strings[reader.read(INDEX)[0]] for _ in range(transits_count + bags_count)]
+    return Vial(line_code=strings[line_code], color=unpack_int(color), type=unpack_int(type),
+                current_zone_id=unpack_int(current_zone_id), current_subzone_id=unpack_int(current_subzone_id),
+                next_zone_id=unpack_int(next_zone_id), fluid_level=unpack_bool(fluid_level),
+                transits=values[:transits_count], centrifuged=unpack_bool(centrifuged), decapped=unpack_bool(decapped),
+                to_centrifuge=unpack_bool(to_centrifuge), to_decap=unpack_bool(to_decap),
+                archive_type=None if archive_type == NONE_INDEX else strings[archive_type],
+                emergency=unpack_bool(emergency),
+                added_time=None if added_time == NONE_INDEX else strings[added_time],
+                blood_bags=values[transits_count:])
+
+def unpack_zone(reader: Reader, strings: list):
+    zone_id, phase, door_opened, zone_type, items_count, subzones_count = reader.read(ZONE)
+    zone_items = []
+    for _ in range(items_count):
+        position, kind = reader.read(ITEM)
+        if kind == PACKED:
+            vial = unpack_vial(reader, strings)
+        elif kind == JSON:
+            vial = Vial(**json.loads(strings[reader.read(INDEX)[0]]))
+        else:
+            raise SnapshotError(f"unknown item kind {kind}")
+        zone_items.append({"position": position, "content": vial})
+    subzones = [unpack_zone(reader, strings) for _ in range(subzones_count)]
+    return zone_id, {"phase": phase, "zone_items": zone_items,
+                     "subzones": [{"zone_id": subzone_id, "zone": subzone} for subzone_id, subzone in subzones],
+                     "door_opened": bool(door_opened), "zone_type": unpack_int(zone_type)}
+
+def decode_snapshot(raw: bytes) -> list:
+    """
+    Returns the zones in the layout of the JSON snapshot, with Vial objects as item contents.
+    """
+    try:
+        reader = Reader(raw)
+        magic, version = reader.read(HEADER)
+        if magic != MAGIC:
+            raise SnapshotError("not a zone snapshot")
+        if version != VERSION:
+            raise SnapshotError(f"unsupported snapshot version {version}")
+        strings = [reader.read_bytes(reader.read(COUNT)[0]).decode('utf-8') for _ in range(reader.read(COUNT)[0])]
+        zones = [unpack_zone(reader, strings) for _ in range(reader.read(COUNT)[0])]
+        return [{"zone_id": zone_id, "zone": zone} for zone_id, zone in zones]
+    except struct.error as e:
+        raise SnapshotError(f"snapshot is truncated: {e}") from e
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any, Callable
+
+import aiofiles
+from configuration import app_data
+from data_manager import write_raw_to_file, write_to_file
+from event_tracker import tasks_auditor,error_auditor
+
+class StateJournal:
+    """
+    Append-only journal of the changes of the stateful zones since the last snapshot.
+    Each record holds the current state of a zone or an item, so replaying a record twice is harmless.
+    The journal is compacted into a new snapshot when it gets too big or too old.
+    """
+    def __init__(self, file_name: str = "zones.journal", snapshot_name: str = None):
+        self.file_name = file_name
+        self.snapshot_name = snapshot_name or ("zones.bin" if app_data.snapshot_format == 'binary' else "zones.json")
+        self.lock = asyncio.Lock()
+        self.size = os.path.getsize(file_name) if os.path.exists(file_name) else 0
+        self.snapshot_time = time.monotonic()
+        self.records_count = 0
+
+    def needs_snapshot(self) -> bool:
+        return (self.size >= app_data.journal_max_size or
+                (self.size > 0 and time.monotonic() - self.snapshot_time >= app_data.snapshot_interval))
+
+    async def append(self, records: list) -> bool:
+        if not records:
+            return True
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        # counted before the write, so concurrent callers see the size they will produce
+        self.size += len(lines)
+        try:
+            async with self.lock:
+                await self.write_records(lines, len(records))
+            return True
+        except Exception as e:
+            error_auditor.error(f"Error writing to {self.file_name}: {e}")
+            return False
+
+    async def write_records(self, lines: str, count: int):
+        async with aiofiles.open(self.file_name, 'a') as file:
+            await file.write(lines)
+            await file.flush()
+            # one fsync for all the records of a call
+            await asyncio.to_thread(os.fsync, file.fileno())
+        self.records_count += count
+
+    async def write_snapshot(self, data: Any, records: list = None) -> bool:
+        """
+        Writes the snapshot and starts a new journal with the given records, the ones the snapshot does not hold.
+        """
+        async with self.lock:
+            if not await write_to_file(data, self.snapshot_name):
+                return False
+            records = records or []
+            lines = "".join(json.dumps(record) + "\n" for record in records)
+            # the new journal replaces the old one at once, so a crash never loses the carried over records
+            if not await write_raw_to_file(lines, self.file_name):
+                return False
+            tasks_auditor.info(f"Journal compacted into {self.snapshot_name}, records: {self.records_count}")
+            self.size = len(lines)
+            self.records_count = len(records)
+            self.snapshot_time = time.monotonic()
+            return True
+
+    async def read_records(self) -> list:
+        if not os.path.exists(self.file_name):
+            return []
+        records = []
+        try:
+            async with aiofiles.open(self.file_name, 'r') as file:
+                raw_data = await file.read()
+        except Exception as e:
+            error_auditor.error(f"Error reading from {self.file_name}: {e}")
+            return []
+        for line in raw_data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # a write cut short by a crash, nothing after it was fsynced
+                error_auditor.error(f"Journal {self.file_name} truncated after {len(records)} records")
+                break
+        return records
+
+    def get_stats(self):
+        return {"journal_size": self.size, "journal_records": self.records_count,
+                "snapshot_age": round(time.monotonic() - self.snapshot_time, 3)}
+
+class StateWriter:
+    """
+    Writes the zone state in the background. Export requests only mark the state dirty,
+    the requests within the debounce interval are written once.
+    """
+    def __init__(self):
+        self.save: Callable = None # coroutine function writing the state, set by the zone manager
+        self.dirty = False
+        self.task: asyncio.Task = None
+        self.backlog = 0 # export requests not written yet
+        self.writes = 0
+        self.last_write_time = 0.0
+        self.last_write_at = None
+        self.lock = asyncio.Lock()
+        self.suspended = 0 # suspend calls not resumed yet
+
+    def mark_dirty(self):
+        self.dirty = True
+        self.backlog += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        # requests arriving during a write are picked up by the next round
+        while self.dirty and not self.suspended:
+            await asyncio.sleep(app_data.snapshot_debounce)
+            await self.flush()
+
+    async def flush(self):
+        # waits for a write in progress, so the state on disk is current when it returns
+        async with self.lock:
+            if not self.dirty or self.suspended:
+                return
+            self.dirty = False
+            backlog, self.backlog = self.backlog, 0
+            start = time.perf_counter()
+            try:
+                await self.save()
+            except Exception as e:
+                error_auditor.error(f"Error writing the zone state for {backlog} requests: {e}")
+            self.writes += 1
+            self.last_write_time = time.perf_counter() - start
+            self.last_write_at = time.time()
+
+    async def suspend(self):
+        # the pending changes are written first, later ones wait for resume, e.g. while the zones are reloaded
+        await self.flush()
+        self.suspended += 1
+
+    def resume(self):
+        self.suspended -= 1
+        if not self.suspended and self.dirty and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    def get_stats(self):
+        return {"backlog": self.backlog, "suspended": self.suspended, "writes": self.writes, "last_write_time": round(self.last_write_time, 3),
+                "last_write_at": self.last_write_at}
+
+state_journal: StateJournal = StateJournal()
+state_writer: StateWriter = StateWriter()
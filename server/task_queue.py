@@ -0,0 +1,70 @@
+from collections import deque
+from enum import Enum
+import time
+from typing import Any, Deque, Dict, Tuple
+
+class TaskPriority(Enum):
+    SAFETY = 1 # doors, pause. Moves can depend on a door planned before them, so doors come first.
+    EMERGENCY = 2 # moves of emergency vials
+    MACHINE = 3 # start, stop
+    NORMAL = 4
+    INIT = 5
+
+class TaskQueue:
+    """
+    Task queue of a robot. Tasks are handed out by priority class,
+    in the order they were added within the same class.
+    """
+    def __init__(self):
+        self.queues: Dict[TaskPriority, Deque[Tuple[Any, float]]] = {priority: deque() for priority in TaskPriority}
+        self.count = 0
+        self.last_wait_time = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def put(self, task, priority: TaskPriority = TaskPriority.NORMAL):
+        self.queues[priority].append((task, time.monotonic()))
+        self.count += 1
+
+    def pop(self):
+        for queue in self.queues.values():
+            if queue:
+                task, added_time = queue.popleft()
+                self.count -= 1
+                self.last_wait_time = time.monotonic() - added_time
+                return task
+        raise IndexError("pop from an empty task queue")
+
+    def drain(self):
+        tasks = [task for queue in self.queues.values() for task, _ in queue]
+        self.clear()
+        return tasks
+
+    def get_random_ids(self) -> set:
+        return {task.random_id for queue in self.queues.values() for task, _ in queue}
+
+    def remove(self, random_ids: set) -> list:
+        # the tasks with the given random ids, e.g. planned ahead and not needed any more
+        removed = [task for queue in self.queues.values() for task, _ in queue if task.random_id in random_ids]
+        for priority, queue in self.queues.items():
+            self.queues[priority] = deque(entry for entry in queue if entry[0].random_id not in random_ids)
+        self.count -= len(removed)
+        return removed
+
+    def clear(self):
+        for queue in self.queues.values():
+            queue.clear()
+        self.count = 0
+
+    def get_oldest_wait_time(self):
+        now = time.monotonic()
+        return max((now - queue[0][1] for queue in self.queues.values() if queue), default=0.0)
+
+    def get_stats(self):
+        return {
+            "depth": self.count,
+            "depth_by_priority": {priority.name: len(queue) for priority, queue in self.queues.items()},
+            "oldest_wait_time": round(self.get_oldest_wait_time(), 3),
+            "last_wait_time": round(self.last_wait_time, 3),
+        }
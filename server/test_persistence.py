@@ -0,0 +1,118 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# zones_config.yaml is read from the working directory, the logs go to a temporary folder
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+os.chdir(SERVER_DIR)
+from configuration import app_data, config
+app_data.audit_path = tempfile.mkdtemp(prefix="audit_")
+
+from snapshot_format import SnapshotError, can_pack, decode_snapshot, encode_snapshot
+from vial import Vial
+from zone import Zone
+
+def get_zone_config(with_subzones: bool):
+    return next(zone for zone in config["zones"] if zone.get("stateful") and bool(zone.get("subzones")) == with_subzones)
+
+def build_zones():
+    return {zone_config["zone_id"]: Zone(zone_config) for zone_config in (get_zone_config(False), get_zone_config(True))}
+
+def get_vials():
+    packable = Vial(line_code="A100", color=1, type=2, current_zone_id=3, transits=["T1", "T2"], archive_type="box",
+                    blood_bags=["B1"], added_time="2024-01-01T10:00:00")
+    fallback = Vial(line_code="A101", color=2, type=2, transits=[1, 2])
+    empty = Vial(line_code="A102", color=None, type=None, current_zone_id=None, current_subzone_id=None, next_zone_id=None,
+                 fluid_level=None, centrifuged=None, decapped=None, to_centrifuge=None, to_decap=None,
+                 archive_type=None, emergency=None, added_time=None)
+    return [packable, fallback, empty]
+
+def fill_zones(zones: dict):
+    # the same vials in every zone and subzone, on the first, a middle and the last items
+    for zone in zones.values():
+        for target in zone.subzones or [zone]:
+            items = target.zone_items
+            for item, vial in zip((items[0], items[len(items)//2], items[-1]), get_vials()):
+                item.set_content(vial)
+            target.set_zone_phase(target.get_next_phase() or target.phase)
+            target.set_door(True)
+            target.set_zone_type(1)
+
+def without_names(data: dict):
+    # the snapshot does not store the zone names
+    data = {key: value for key, value in data.items() if key != "zone_name"}
+    data["subzones"] = [{"zone_id": subzone["zone_id"], "zone": without_names(subzone["zone"])} for subzone in data["subzones"]]
+    return data
+
+def with_exported_vials(data: dict):
+    data = dict(data)
+    data["zone_items"] = [{**item, "content": item["content"].export_data(False)} for item in data["zone_items"]]
+    data["subzones"] = [{"zone_id": subzone["zone_id"], "zone": with_exported_vials(subzone["zone"])} for subzone in data["subzones"]]
+    return data
+
+def export_zones(zones: dict):
+    return {zone_id: zone.export_data() for zone_id, zone in zones.items()}
+
+def replay_records():
+    # runs in a new process: reads the journal records from stdin, prints the exported zones
+    zones = build_zones()
+    for record in json.load(sys.stdin):
+        zone = zones[record["zone_id"]]
+        if record["subzone_id"] is not None:
+            zone = zone.get_subzone_by_id(record["subzone_id"])
+        zone.import_record(record)
+    json.dump(export_zones(zones), sys.stdout)
+
+class SnapshotFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.zones = build_zones()
+        fill_zones(self.zones)
+
+    def test_vials_cover_both_encodings(self):
+        self.assertEqual([can_pack(vial) for vial in get_vials()], [True, False, True])
+
+    def test_round_trip_matches_export(self):
+        decoded = decode_snapshot(encode_snapshot(list(self.zones.items())))
+        self.assertEqual([entry["zone_id"] for entry in decoded], list(self.zones))
+        for entry in decoded:
+            expected = without_names(self.zones[entry["zone_id"]].export_data())
+            self.assertEqual(with_exported_vials(entry["zone"]), expected)
+
+    def test_round_trip_restores_vials(self):
+        decoded = decode_snapshot(encode_snapshot(list(self.zones.items())))
+        zone_items = decoded[0]["zone"]["zone_items"]
+        self.assertEqual([item["content"] for item in zone_items], get_vials())
+
+    def test_bad_magic(self):
+        raw = encode_snapshot(list(self.zones.items()))
+        with self.assertRaises(SnapshotError):
+            decode_snapshot(b"XXXX" + raw[4:])
+
+    def test_truncated(self):
+        raw = encode_snapshot(list(self.zones.items()))
+        for size in (0, 3, 10, len(raw)//2, len(raw)-1):
+            with self.subTest(size=size), self.assertRaises(SnapshotError):
+                decode_snapshot(raw[:size])
+
+class JournalReplayTest(unittest.TestCase):
+    def test_replay_in_new_process(self):
+        zones = build_zones()
+        fill_zones(zones)
+        # a vial removed after it was journaled is replayed as an empty item
+        target = next(iter(zones.values()))
+        item = target.zone_items[0]
+        records = [record for zone_id, zone in zones.items() for record in zone.get_journal_records(zone_id)]
+        item.remove_content()
+        records += target.get_journal_records(target.zone_id)
+        self.assertEqual(target.get_journal_records(target.zone_id), [])
+
+        result = subprocess.run([sys.executable, "-c", "import test_persistence; test_persistence.replay_records()"],
+                                input=json.dumps(records), capture_output=True, text=True, cwd=SERVER_DIR, check=True)
+        replayed = {int(zone_id): data for zone_id, data in json.loads(result.stdout).items()}
+        self.assertEqual(replayed, export_zones(zones))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,17 @@
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Callable, ClassVar
 import json
 from random import choice, random
 from configuration import COLORS, VIAL_TYPE, TransitData, ZoneTransition,app_data
 from event_tracker import tasks_auditor
 import webcolors
+
+@lru_cache(maxsize=4096)
+def parse_time(value:str)->datetime:
+    return datetime.fromisoformat(value)
+
 @dataclass
 class Vial:
     line_code:str
@@ -24,19 +31,39 @@ class Vial:
     emergency: bool= False
     added_time: str =datetime.now().isoformat()
     blood_bags:list=field(default_factory=list) 
+    # called with the vial and its previous (zone, subzone) when it moves, set by the vial manager
+    location_listener:ClassVar[Callable]=None
+    # called with the vial when any of its fields changes, set by the vial manager
+    change_listener:ClassVar[Callable]=None
+
+    def __setattr__(self,name,value):
+        super().__setattr__(name,value)
+        self.notify_change()
+
+    def notify_change(self):
+        if Vial.change_listener:
+            Vial.change_listener(self)
 
     def set_zone(self,current_zone_id):
+        location=(self.current_zone_id,self.current_subzone_id)
         self.current_zone_id=current_zone_id
+        self.notify_location(location)
 
     def set_subzone(self,subzone_id):
+        location=(self.current_zone_id,self.current_subzone_id)
         self.current_subzone_id =subzone_id
+        self.notify_location(location)
+
+    def notify_location(self,location):
+        if Vial.location_listener and location != (self.current_zone_id,self.current_subzone_id):
+            Vial.location_listener(self,location)
 
     def set_next_zone(self,zone_id):
         self.next_zone_id=zone_id
 
     def move_to_next_zone(self):
         if self.next_zone_id:
-            self.current_zone_id = self.next_zone_id.pop(0)
+            self.set_zone(self.next_zone_id.pop(0))
         else:
             print("No more zones to move to.")
 
@@ -68,24 +95,26 @@ class Vial:
             self.transits[0] = arch
         else:
             self.transits.pop(0)
+        self.notify_change()
 
     def matches(self, transition:'ZoneTransition'):
-        disposal_time =app_data.disposal_time
-        added_dt= datetime.fromisoformat(self.added_time)
         return ((self.next_zone_id is None or transition.next_zone_id is None or self.next_zone_id == transition.next_zone_id) and
-            (not transition.transits or not self.transits or self.transits[0] in transition.transits) and
-            (self.color is None or not transition.colors or self.color in transition.colors) and
-            (self.type is None or not transition.types or self.type in transition.types) and
+            (not transition.transit_set or not self.transits or self.transits[0] in transition.transit_set) and
+            (self.color is None or not transition.color_set or self.color in transition.color_set) and
+            (self.type is None or not transition.type_set or self.type in transition.type_set) and
             (self.centrifuged is None or transition.centrifuged is None or self.centrifuged == transition.centrifuged) and
-            (transition.disposable is False or datetime.now() - added_dt > timedelta(seconds=disposal_time))) 
+            (not transition.check_disposal or datetime.now() - parse_time(self.added_time) > timedelta(seconds=app_data.disposal_time))) 
     
     def export_data(self,is_gui):
         if is_gui:
             color_key = int(self.color) if self.color is not None else None
             type_key = int(self.type) if self.type is not None else None
-            color_name = COLORS[color_key] if color_key is not None and color_key in COLORS else None
+            display = COLOR_DISPLAY.get(color_key)
+            if display is None:
+                color_name = COLORS[color_key] if color_key is not None and color_key in COLORS else None
+                display = (color_name, self.name_to_hex(color_name))
             type_name = VIAL_TYPE[type_key] if type_key is not None and type_key in VIAL_TYPE else None
-            return {"line_code":"STR_"+self.line_code,"color":color_name,"color_hex":self.name_to_hex(color_name),"type":type_name,"fluid_level":self.fluid_level,"transits":self.transits,"added_time":self.added_time}
+            return {"line_code":"STR_"+self.line_code,"color":display[0],"color_hex":display[1],"type":type_name,"fluid_level":self.fluid_level,"transits":self.transits,"added_time":self.added_time}
         return json.dumps(self.__dict__)
    
     def get_transits_order(self):
@@ -130,14 +159,25 @@ class Vial:
                     self.blood_bags.append(bag)
             tasks_auditor.info(f"Pilots added for the sample: {self.line_code}: {self.blood_bags} ")
     def name_to_hex(self,color:str):
-        if not color:
-            return None
-        # print("BEFORE")
-        # print(color)
-        if (color == "CLEAR" or color == "PILOT" or color == "COUNTER"):
-            color="WHITE"
-        elif color == "BIGRED":
-            color="RED"
-        # print("COLOR")
-        # print(COLORS[color])
-        return webcolors.name_to_hex(str.lower(color))
\ No newline at end of file
+        return color_name_to_hex(color)
+
+def color_name_to_hex(color:str):
+    if not color:
+        return None
+    if (color == "CLEAR" or color == "PILOT" or color == "COUNTER"):
+        color="WHITE"
+    elif color == "BIGRED":
+        color="RED"
+    return webcolors.name_to_hex(str.lower(color))
+
+def get_color_display():
+    # GUI name and hex of the configured colors, the colors webcolors does not know are left to fail on export as before
+    display={}
+    for key,name in COLORS.items():
+        try:
+            display[key]=(name,color_name_to_hex(name))
+        except ValueError:
+            continue
+    return display
+
+COLOR_DISPLAY:dict[int,tuple] =get_color_display()
\ No newline at end of file
@@ -1,52 +1,186 @@
 import asyncio
 from datetime import datetime
+import json
 import os
+import sys
 from typing import Counter
-from configuration import COLORS, TransitData,app_data,name_to_hex
+from configuration import COLORS, TransitData, VialState,app_data,name_to_hex
 from vial import Vial
-from event_tracker import tasks_auditor,error_auditor
+from event_tracker import tasks_auditor,error_auditor,vials_auditor
 
 class VialManager:
 
     def __init__(self, vials:list[Vial]=[]):
-        self.vials:list[Vial]=vials
+        self.vials:dict[int, Vial]={} # by id of the vial, in the order they were added
+        self.vials_by_code:dict[str, list[Vial]]={} # several vials can share a line code, e.g. Fehler duplicates
+        self.vials_by_location:dict[tuple[int, int], dict[int, Vial]]={} # (zone, subzone) -> vials by id
+        self.vial_order:dict[int, int]={} # order in which the vials were added
+        self.added_count=0
+        self.items_by_code:dict[str, dict[int, 'ZoneItem']]={} # zone items holding a vial, by line code and id of the vial
+        self.vial_states:dict[int, VialState]={}
+        self.disposed_count=0
+        Vial.location_listener=self.update_location
+        Vial.change_listener=self.update_vial
+        for vial in vials:
+            self.add_vial(vial)
     
     def add_vial(self,vial:Vial):
-        self.vials.append(vial)
+        if id(vial) in self.vials:
+            return
+        self.vials[id(vial)]=vial
+        self.vials_by_code.setdefault(vial.line_code,[]).append(vial)
+        self.vials_by_location.setdefault((vial.current_zone_id,vial.current_subzone_id),{})[id(vial)]=vial
+        self.vial_order[id(vial)]=self.added_count
+        self.added_count+=1
+        item=self.get_item(vial)
+        self.vial_states[id(vial)]=VialState.ARCHIVED if item and item.zone and item.zone.is_stateful() else VialState.ACTIVE
+
+    def add_vials(self,vials:list[Vial]):
+        for vial in vials:
+            self.add_vial(vial)
+
+    def update_location(self,vial:Vial,location:tuple[int, int]):
+        if id(vial) not in self.vials:
+            return
+        self.remove_location(vial,location)
+        self.vials_by_location.setdefault((vial.current_zone_id,vial.current_subzone_id),{})[id(vial)]=vial
+
+    def remove_location(self,vial:Vial,location:tuple[int, int]):
+        vials=self.vials_by_location.get(location)
+        if vials:
+            vials.pop(id(vial),None)
+            if not vials:
+                del self.vials_by_location[location]
+
+    def update_vial(self,vial:Vial):
+        # the vial can still be in its __init__
+        items=self.items_by_code.get(vial.__dict__.get('line_code'))
+        item=items.get(id(vial)) if items else None
+        if item and item.zone:
+            # colors and emergency flags are changed in place, e.g. by the camera results
+            item.zone.update_color_count(item)
+            item.zone.update_emergency_index(item)
+            item.zone.mark_item(item)
+            item.zone.touch()
+
+    def get_vials_at(self,zone_id:int,subzone_id:int)->list[Vial]:
+        # a copy in the order the vials were added, callers move the vials while iterating
+        return sorted(self.vials_by_location.get((zone_id,subzone_id),{}).values(),key=lambda vial: self.vial_order[id(vial)])
+
+    def set_item(self,vial:Vial,item:'ZoneItem'):
+        self.items_by_code.setdefault(vial.line_code,{})[id(vial)]=item
+        if id(vial) in self.vials:
+            self.vial_states[id(vial)]=VialState.ARCHIVED if item.zone and item.zone.is_stateful() else VialState.ACTIVE
+
+    def remove_item(self,vial:Vial,item:'ZoneItem'):
+        items=self.items_by_code.get(vial.line_code)
+        # the vial can already be placed in its next item
+        if items and items.get(id(vial)) is item:
+            del items[id(vial)]
+            if not items:
+                del self.items_by_code[vial.line_code]
+
+    def get_item(self,vial:Vial)->'ZoneItem':
+        return self.items_by_code.get(vial.line_code,{}).get(id(vial))
+
+    def get_items_by_code(self,line_code)->list['ZoneItem']:
+        return list(self.items_by_code.get(line_code,{}).values())
+
+    def get_vials_by_code(self, line_code)->list[Vial]:
+        return self.vials_by_code.get(line_code,[])
 
     def get_vial(self, line_code=None):
         if line_code :
-            return next((vial for vial in self.vials if vial.line_code == line_code), None)
+            return next(iter(self.get_vials_by_code(line_code)), None)
         return None
     
+    def set_line_code(self,vial:Vial,line_code:str):
+        item=self.get_item(vial)
+        if item:
+            self.remove_item(vial,item)
+        if id(vial) in self.vials:
+            self.remove_code(vial)
+            vial.line_code=line_code
+            self.vials_by_code.setdefault(line_code,[]).append(vial)
+        else:
+            vial.line_code=line_code
+        if item:
+            self.set_item(vial,item)
+            if item.zone:
+                item.zone.mark_item(item)
+
+    def remove_code(self,vial:Vial):
+        vials=self.vials_by_code.get(vial.line_code)
+        if vials:
+            vials[:]=[v for v in vials if v is not vial]
+            if not vials:
+                del self.vials_by_code[vial.line_code]
+
     def set_transit(self, line_code:str,transit:str,bags=None):
-        for vial in self.vials:
-            if vial.line_code == line_code:
-                vial.set_transit(transit,bags)
-                return True
+        vial=self.get_vial(line_code)
+        if vial:
+            vial.set_transit(transit,bags)
+            return True
         return False 
     
-    def restart(self):
-        self.vials=[]
+    def restart(self,archiv_reset=False):
+        # zone items are emptied by the zones, archives can keep theirs and import them again
+        for vial in list(self.vials.values()):
+            if archiv_reset or self.get_state(vial) == VialState.ACTIVE:
+                self.dispose_vial(vial,"restart")
+        self.vials={}
+        self.vials_by_code={}
+        self.vials_by_location={}
+        self.vial_order={}
+        self.vial_states={}
     
     def validate_line_code(self,line_code):
         vial=self.get_vial(line_code) 
         if vial and vial.current_zone_id in (10,101,102):
-            vial.line_code= vial.line_code+'000'
+            self.set_line_code(vial,vial.line_code+'000')
     
     def delete_vial(self,vial:Vial):
-        if vial: 
-            self.vials.remove(vial)    
+        if vial and id(vial) in self.vials: 
+            del self.vials[id(vial)]
+            self.remove_code(vial)
+            self.remove_location(vial,(vial.current_zone_id,vial.current_subzone_id))
+            del self.vial_order[id(vial)]
+            del self.vial_states[id(vial)]
+
+    def get_state(self,vial:Vial)->VialState:
+        return self.vial_states.get(id(vial),VialState.DISPOSED)
+
+    def dispose_vial(self,vial:Vial,reason:str):
+        if not vial or id(vial) not in self.vials:
+            return
+        self.delete_vial(vial)
+        self.disposed_count+=1
+        if app_data.vial_history:
+            vials_auditor.info(json.dumps({"line_code":vial.line_code,"color":vial.color,"type":vial.type,"transits":vial.transits,
+                                           "zone_id":vial.current_zone_id,"subzone_id":vial.current_subzone_id,"added_time":vial.added_time,
+                                           "disposed_time":datetime.now().isoformat(),"reason":reason}))
+
+    def get_stats(self):
+        states=Counter(state.name for state in self.vial_states.values())
+        return {
+            "vials": len(self.vials),
+            "by_state": {state.name: states.get(state.name,0) for state in (VialState.ACTIVE,VialState.ARCHIVED)},
+            "disposed": self.disposed_count,
+            "line_codes": len(self.vials_by_code),
+            "locations": len(self.vials_by_location),
+            "placed": sum(len(items) for items in self.items_by_code.values()),
+            "index_bytes": sum(sys.getsizeof(index) for index in (self.vials,self.vials_by_code,self.vials_by_location,self.vial_order,self.items_by_code,self.vial_states)),
+        }
 
     def set_transit_data(self, transit_data:TransitData):
-        for vial in self.vials:
-            if vial.line_code == transit_data.line_code:
-                vial.set_transit_data(transit_data)
-                return True
+        vial=self.get_vial(transit_data.line_code)
+        if vial:
+            vial.set_transit_data(transit_data)
+            return True
         return False
 
     def is_duplicate_vial(self,line_code):
         if line_code:
-            return sum(1 for vial in self.vials if vial.line_code == line_code and vial.current_zone_id != 10) >= 1
+            return any(vial.current_zone_id != 10 for vial in self.get_vials_by_code(line_code))
 
 vial_manager: VialManager= VialManager()
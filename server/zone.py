@@ -1,4 +1,6 @@
 import asyncio
+from bisect import bisect_left, insort
+from collections import Counter
 from datetime import datetime, timedelta
 import json
 import operator
@@ -8,13 +10,19 @@ from vial import Vial
 from configuration import ItemType, ZonePhase,app_data
 from vial_manager import vial_manager
 from zone_item import ZoneItem
-from event_tracker import tasks_auditor
+from zone_events import zone_events
+from event_tracker import tasks_auditor,error_auditor
 
 async def execute_after_time(t:int,method ,*args):
     await asyncio.sleep(t)
     method(args)
 
 class Zone:
+    state_version:int =0 # bumped on any change of any zone
+    change_listener=None # called on any change of any zone, set by the zone manager
+    # fields a move or its post operations can change besides the items, kept to undo a lookahead
+    checkpoint_fields =("phase","door_opened","zone_type","run_time","controls_processed","pick_index","place_index",
+                        "last_init_time","unload_time","rotorNo")
     
     def __init__(self, data):
         self.zone_id = data['zone_id']
@@ -24,6 +32,14 @@ class Zone:
         self.run_time= data.get('run_time', 0)
         self.phase_order = data.get('phase_order', [])
         self.limits_by_color = data.get('limits_by_color', None)
+        self.color_limit_groups = self.get_color_limit_groups(self.limits_by_color)
+        self.color_counts:Counter =Counter() # colors of the vials in the zone items
+        self.emergency_indexes:set[int] =set() # indexes of the items holding emergency vials
+        self.emergency_count:int =0 # emergency vials in the zone and its subzones
+        self.sorted_items:dict[str, tuple[int, list[ZoneItem]]] ={} # order key -> (zone version, sorted items)
+        self.gui_export:tuple[int, dict] =None # (zone version, GUI export of the zone)
+        self.saved_version:int =-1 # version written to the journal
+        self.dirty_indexes:set[int] =set() # items changed since they were written to the journal
         self.phase= ZonePhase(self.phase_order[0] if self.phase_order else 1)
         self.rows= data.get('rows',0)
         self.columns= data.get('columns',0)
@@ -49,6 +65,23 @@ class Zone:
         self.unload_time =None
         self.controls_processed =False
         self.rotorNo=1
+        self.parent:'Zone' =None
+        self.version:int =0 # state version of the last change of the zone or its subzones
+        self.filled_count:int =0
+        self.empty_indexes:list[int] =list(range(len(self.zone_items))) # sorted indexes of the empty items
+        self.free_slots:dict[tuple, list[int]] ={} # sorted indexes of the empty items by slot key (transit, color, types)
+        self.slot_items:dict[tuple, ZoneItem] ={} # an item of each slot key, to match the key against transitions
+        for index,item in enumerate(self.zone_items):
+            item.zone=self
+            item.index=index
+            self.add_free_slot(item)
+        self.phase_counts:Counter =Counter() # phases of the leaf zones, used to filter transitions
+        for subzone in self.subzones:
+            subzone.parent=self
+            self.phase_counts.update(subzone.phase_counts)
+            self.emergency_count += subzone.emergency_count
+        if not self.subzones:
+            self.phase_counts[self.phase] +=1
 
     def get_subzone_by_id(self,id):
         if self.subzones:
@@ -58,10 +91,113 @@ class Zone:
         if not limits: return None  
         return {color: limit for color, limit in limits}
 
-    def get_next_empty_item(self)->ZoneItem:  
+    def get_color_limit_groups(self,limits):
+        if not limits: return []
+        # single integer or list of integers per group
+        return [(frozenset([limit['color']] if isinstance(limit['color'], int) else limit['color']), limit['limit']) for limit in limits]
+
+    def update_color_count(self,item:ZoneItem):
+        color= item.content.color if item.content else None
+        if color == item.counted_color:
+            return
+        if item.counted_color is not None:
+            self.color_counts[item.counted_color] -=1
+            if not self.color_counts[item.counted_color]:
+                del self.color_counts[item.counted_color]
+        if color is not None:
+            self.color_counts[color] +=1
+        item.counted_color=color
+
+    def update_emergency_index(self,item:ZoneItem):
+        emergency= bool(item.content and item.content.is_emergency())
+        if emergency == (item.index in self.emergency_indexes):
+            return
+        if emergency:
+            self.emergency_indexes.add(item.index)
+        else:
+            self.emergency_indexes.discard(item.index)
+        zone=self
+        while zone:
+            zone.emergency_count += 1 if emergency else -1
+            zone=zone.parent
+
+    def mark_item(self,item:ZoneItem):
+        self.dirty_indexes.add(item.index)
+
+    def update_item(self,item:ZoneItem,was_empty:bool):
+        self.mark_item(item)
+        self.update_color_count(item)
+        self.update_emergency_index(item)
+        is_empty=item.content is None
+        if was_empty != is_empty:
+            if is_empty:
+                self.filled_count -=1
+                insort(self.empty_indexes,item.index)
+                self.add_free_slot(item)
+            else:
+                self.filled_count +=1
+                self.empty_indexes.pop(bisect_left(self.empty_indexes,item.index))
+                self.remove_free_slot(item)
+        self.touch()
+        if zone_events.is_active() and not (was_empty and is_empty):
+            if is_empty:
+                zone_events.publish("vial_removed",**self.get_event_ids(),position=item.position)
+            else:
+                zone_events.publish("vial_placed",**self.get_event_ids(),position=item.position,content=item.content.export_data(True))
+
+    def get_event_ids(self):
+        # the zone and subzone ids used by the GUI exports
+        root=self
+        while root.parent:
+            root=root.parent
+        return {"zone_id":root.zone_id,"subzone_id":self.zone_id if self.parent else None}
+
+    def add_free_slot(self,item:ZoneItem):
+        key=item.get_slot_key()
+        self.slot_items.setdefault(key,item)
+        insort(self.free_slots.setdefault(key,[]),item.index)
+
+    def remove_free_slot(self,item:ZoneItem):
+        indexes=self.free_slots.get(item.get_slot_key())
+        if indexes:
+            pos=bisect_left(indexes,item.index)
+            if pos < len(indexes) and indexes[pos] == item.index:
+                indexes.pop(pos)
+
+    def get_free_slots(self):
+        free_slots={}
         for item in self.zone_items:
             if item.content is None:
-                return item
+                free_slots.setdefault(item.get_slot_key(),[]).append(item.index)
+        return free_slots
+
+    def verify_counters(self):
+        empty_indexes=[item.index for item in self.zone_items if item.content is None]
+        free_slots=self.get_free_slots()
+        color_counts=Counter(item.content.color for item in self.zone_items if item.content and item.content.color is not None)
+        emergency_indexes={item.index for item in self.zone_items if item.content and item.content.is_emergency()}
+        if (self.empty_indexes != empty_indexes or self.filled_count != len(self.zone_items)-len(empty_indexes)
+            or {key: indexes for key,indexes in self.free_slots.items() if indexes} != free_slots
+            or self.color_counts != color_counts or self.emergency_indexes != emergency_indexes):
+            error_auditor.error(f"{self.name} occupancy counters out of sync, count: {self.filled_count}, empty: {self.empty_indexes}, expected empty: {empty_indexes}")
+            self.empty_indexes=empty_indexes
+            self.filled_count=len(self.zone_items)-len(empty_indexes)
+            self.free_slots=free_slots
+            self.color_counts=color_counts
+            zone=self
+            while zone:
+                zone.emergency_count += len(emergency_indexes)-len(self.emergency_indexes)
+                zone=zone.parent
+            self.emergency_indexes=emergency_indexes
+            for item in self.zone_items:
+                self.slot_items.setdefault(item.get_slot_key(),item)
+                item.counted_color=item.content.color if item.content else None
+
+    def get_next_empty_item(self)->ZoneItem:  
+        if app_data.debug_zone_counters:
+            self.verify_counters()
+        if self.empty_indexes:
+            return self.zone_items[self.empty_indexes[0]]
         return None
     
     def get_empty_item(self,position)->ZoneItem:  
@@ -91,9 +227,37 @@ class Zone:
             self.phase=phase[0]
         else:
             self.phase=phase
+        self.update_phase_counts(p,self.phase)
+        self.touch()
+        if zone_events.is_active() and p != self.phase:
+            zone_events.publish("phase_changed",**self.get_event_ids(),phase=self.phase.value)
         #if self.name != "Camera1" and self.name != "Camera2" and self.name != "Dummy Camera2":
         tasks_auditor.info(f"{self.name} changed from {p} to {self.phase}")
     
+    def update_phase_counts(self,old_phase:ZonePhase,new_phase:ZonePhase):
+        if self.subzones or old_phase == new_phase:
+            return
+        zone=self
+        while zone:
+            zone.phase_counts[old_phase] -=1
+            zone.phase_counts[new_phase] +=1
+            zone=zone.parent
+
+    def touch(self):
+        Zone.state_version +=1
+        zone=self
+        while zone:
+            zone.version =Zone.state_version
+            zone=zone.parent
+        if Zone.change_listener:
+            Zone.change_listener()
+
+    def is_stateful(self)->bool:
+        return bool(self.stateful or (self.parent and self.parent.is_stateful()))
+
+    def has_phase(self,phases)->bool:
+        return any(self.phase_counts[phase] > 0 for phase in phases)
+
     def get_zone_phase(self):
         return self.phase
     
@@ -166,7 +330,11 @@ class Zone:
                 next_item.set_content(curr_item.content)
                 curr_item.remove_content() 
         if self.zone_type:
-            (next_sub_zone or next_zone).zone_type = self.zone_type
+            (next_sub_zone or next_zone).set_zone_type(self.zone_type)
+
+    def set_zone_type(self,zone_type):
+        self.zone_type=zone_type
+        self.touch()
     
     def get_sub_zone_to_start(self):
         return next((subzone for subzone in self.subzones if subzone.phase == ZonePhase.READY_TO_START), None)
@@ -184,7 +352,7 @@ class Zone:
     def get_subzone_to_pick(self, transition:ZoneTransition):
         num_subzones = len(self.subzones)
         # Step 1: Pick emergency subzone first, if any
-        for phase in transition.curr_phases:
+        for phase in transition.curr_phases if self.emergency_count else []:
             subzone = next((subzone for subzone in self.subzones if subzone.phase == phase and subzone.is_emergency_zone()), None)
             if subzone:
                 return subzone        
@@ -243,17 +411,24 @@ class Zone:
     
     def get_sorted(self,prop=None)-> list[ZoneItem]:
         if prop:
-            return sorted(self.zone_items, key=operator.attrgetter(prop))
+            # any change of the items bumps the zone version
+            cached=self.sorted_items.get(prop)
+            if cached and cached[0] == self.version:
+                return cached[1]
+            items=sorted(self.zone_items, key=operator.attrgetter(prop))
+            self.sorted_items[prop]=(self.version,items)
+            return items
         else:
             return self.zone_items
         
     def get_next_item_transition(self,transition:'ZoneTransition',emergency=False):
         items=self.get_sorted(transition.curr_order_by)     
         #for emergency
-        for item in items:
-            if item and item.content and item.content.is_emergency():
-                if item.content.matches(transition):
-                    return item   
+        if self.emergency_indexes:
+            for item in items:
+                if item and item.content and item.content.is_emergency():
+                    if item.content.matches(transition):
+                        return item   
         if emergency:
             return  None
         if transition.pick_index:
@@ -271,54 +446,47 @@ class Zone:
         return None
     
     def get_next_empty_item_transition(self,transition:'ZoneTransition'):
-        items=self.zone_items
+        if app_data.debug_zone_counters:
+            self.verify_counters()
+        if self.color_limit_exceeded(transition.colors):
+            return None
+        total_items = len(self.zone_items)
+        start = transition.place_index % total_items if transition.place_index and total_items else 0
+        # nearest empty matching item at or after the start index, wrapping around
+        next_index = None
+        distance = total_items
+        for key, indexes in self.free_slots.items():
+            if not indexes or not self.slot_items[key].matches(transition):
+                continue
+            pos = bisect_left(indexes, start)
+            index = indexes[pos] if pos < len(indexes) else indexes[0]
+            if (index - start) % total_items < distance:
+                next_index = index
+                distance = (index - start) % total_items
+        if next_index is None:
+            return None
         if transition.place_index:
-            total_items = len(items)
-            for i in range(total_items):
-                index = (transition.place_index + i) % total_items
-                item:ZoneItem=items[index]
-                if item and item.content is None and item.matches(transition) and not self.color_limit_exceeded(transition.colors):
-                    transition.place_index = index 
-                    return items[index]
-        else:
-            for item in items:
-                if item.content is None and item.matches(transition) and not self.color_limit_exceeded(transition.colors):
-                    return item
-        return None
+            transition.place_index = next_index
+        return self.zone_items[next_index]
     
     def color_limit_exceeded(self, colors):
-        if not colors or not self.limits_by_color:
+        if not colors or not self.color_limit_groups:
             return False
-
-        # Count how many items in the zone match the given color IDs
-        color_count = {}
-        for obj in self.zone_items:
-            if obj.content and obj.content.color in colors:
-                color_id = obj.content.color
-                color_count[color_id] = color_count.get(color_id, 0) + 1
-
-        if not color_count:
+        if app_data.debug_zone_counters:
+            self.verify_counters()
+        # Count only the vials of the given color IDs
+        if not any(self.color_counts[color_id] for color_id in colors):
             return False
-
-        # Check limits, supporting single integer or list of integers
-        for item in self.limits_by_color:
-            item_colors = item['color']
-            if isinstance(item_colors, int):  # convert single int to list
-                item_colors = [item_colors]
-
-            total_for_group = sum(color_count.get(color_id, 0) for color_id in item_colors)
-            if total_for_group >= item['limit']:
+        for group_colors, limit in self.color_limit_groups:
+            total_for_group = sum(self.color_counts[color_id] for color_id in group_colors if color_id in colors)
+            if total_for_group >= limit:
                 return True
-
         return False
 
-
-    
     def is_loading_started(self,t:ZoneTransition):
         if self.phase != ZonePhase.READY_TO_LOAD:
             return False
-        count = sum(1 for obj in self.zone_items if obj.content) 
-        return count == 1
+        return self.get_count() == 1
     
     def progress_phase(self):
         try:
@@ -329,8 +497,7 @@ class Zone:
     def is_loading(self):
         if self.phase != ZonePhase.LOADING:
             return False
-        count = sum(1 for obj in self.zone_items if obj.content) 
-        return count >= 1
+        return self.get_count() >= 1
     
     def has_subzones(self):
         return len(self.subzones)>0
@@ -340,21 +507,31 @@ class Zone:
     
     def set_door(self,open:bool):
         self.door_opened =open
+        self.touch()
+        if zone_events.is_active():
+            zone_events.publish("door_changed",**self.get_event_ids(),door_opened=open)
     
     def set_door_close(self):
-        self.door_opened =False	
+        self.set_door(False)
     
     def get_count(self):
-        return sum(1 for obj in self.zone_items if obj.content)
+        if app_data.debug_zone_counters:
+            self.verify_counters()
+        return self.filled_count
 
     async def restart(self):
         if self.subzones:
             for subzone in self.subzones: 
                 await subzone.restart()
         for item in self.zone_items:
+            vial=item.content
             item.remove_content()
+            vial_manager.dispose_vial(vial,f"{self.name} reset")
+        p=self.phase
         self.phase= ZonePhase(self.phase_order[0] if self.phase_order else 1)
+        self.update_phase_counts(p,self.phase)
         self.door_opened =False
+        self.touch()
         self.pick_index=0
         self.place_index=0
         self.last_init_time=None
@@ -374,6 +551,9 @@ class Zone:
                             vial.progress_transit()                        
 
     def export_data(self,is_gui=False):
+        # any change of the zone, its subzones or their vials bumps the zone version
+        if is_gui and self.gui_export and self.gui_export[0] == self.version:
+            return self.gui_export[1]
         subzones=[]
         if self.subzones:            
             for subzone in self.subzones:
@@ -382,24 +562,37 @@ class Zone:
         for item in self.zone_items:
             if item.content:
                 zone_items.append(item.export_data(is_gui))
-        return {"phase":self.phase.value,"zone_items": zone_items,"subzones":subzones,"door_opened": self.door_opened, "zone_type": self.zone_type,"zone_name":self.name}
+        data={"phase":self.phase.value,"zone_items": zone_items,"subzones":subzones,"door_opened": self.door_opened, "zone_type": self.zone_type,"zone_name":self.name}
+        if is_gui:
+            self.gui_export=(self.version,data)
+        return data
 
     def import_data(self,data):
         try:
+            p=self.phase
             self.phase=ZonePhase(data["phase"])
+            self.update_phase_counts(p,self.phase)
             self.zone_type = data.get("zone_type", self.zone_type)
             if self.stateful:
                 self.door_opened =bool(data["door_opened"] if 'door_opened' in data else False)
+            self.touch()
             zone_items= data["zone_items"]
             if self.zone_id == 20:
                 if self.phase == ZonePhase.IN_PROCESS:
                     self.progress_phase()
+            empty_items={item.position: item for item in reversed(self.zone_items) if item.content is None}
+            vials=[]
             for zone_item in zone_items:
-                item=self.get_empty_item(zone_item["position"])
-                content=json.loads(zone_item["content"])
-                content=Vial(**content)
+                item=empty_items.pop(zone_item["position"],None)
+                if item is None:
+                    error_auditor.error(f"{self.name} has no empty item at position {zone_item['position']} to restore")
+                    continue
+                content=zone_item["content"]
+                if not isinstance(content,Vial): # the binary snapshot holds the vials
+                    content=Vial(**json.loads(content))
                 item.set_content(content)   
-                vial_manager.add_vial(content)
+                vials.append(content)
+            vial_manager.add_vials(vials)
             subzones=data["subzones"]
             if subzones:
                 for subzone_obj in subzones:
@@ -408,6 +601,47 @@ class Zone:
         except Exception as e:
             print(e)
 
+    def get_journal_records(self,zone_id,subzone_id=None)->list:
+        # current state of the changed zones and items, the marks are cleared
+        records=[]
+        if self.version != self.saved_version:
+            records.append({"zone_id":zone_id,"subzone_id":subzone_id,"phase":self.phase.value,"door_opened":self.door_opened,"zone_type":self.zone_type})
+            self.saved_version=self.version
+        for index in sorted(self.dirty_indexes):
+            item=self.zone_items[index]
+            records.append({"zone_id":zone_id,"subzone_id":subzone_id,"position":item.position,"content":item.content.export_data(False) if item.content else None})
+        self.dirty_indexes.clear()
+        for subzone in self.subzones:
+            records.extend(subzone.get_journal_records(zone_id,subzone.zone_id))
+        return records
+
+    def mark_saved(self):
+        self.saved_version=self.version
+        self.dirty_indexes.clear()
+        for subzone in self.subzones:
+            subzone.mark_saved()
+
+    def import_record(self,record):
+        if "phase" in record:
+            p=self.phase
+            self.phase=ZonePhase(record["phase"])
+            self.update_phase_counts(p,self.phase)
+            self.door_opened=bool(record.get("door_opened",False))
+            self.zone_type=record.get("zone_type",self.zone_type)
+            self.touch()
+            return
+        item:ZoneItem=next((i for i in self.zone_items if i.position == record["position"]), None)
+        if item is None:
+            return
+        if item.content:
+            vial=item.content
+            item.remove_content()
+            vial_manager.delete_vial(vial)
+        if record["content"]:
+            content=Vial(**json.loads(record["content"]))
+            item.set_content(content)
+            vial_manager.add_vial(content)
+
     def has_capacity(self):
         if self.subzones:            
             for subzone in self.subzones:
@@ -427,22 +661,12 @@ class Zone:
                 tasks_auditor.info(f"Task: {self.start_task.get_name()} cancelled successfully.")
                 
     def get_item_by_line_code(self,barcode):
-        if self.subzones:
-            for subzone in self.subzones:
-                item= subzone.get_item_by_line_code(barcode)
-                if item:
-                    return item
-        else:
-            for item in self.zone_items:
-                if item.content and item.content.line_code == barcode:
-                    return item
-        return None
+        return self.get_item_by_line_code_zone_type(barcode)
     
     def is_emergency_zone(self):
-        for item in self.zone_items:
-            if item.content and item.content.is_emergency():
-                return True
-        return False
+        if app_data.debug_zone_counters:
+            self.verify_counters()
+        return bool(self.emergency_indexes)
     
     def is_emergency_pos(self,position)->bool:        
         item:ZoneItem= self.zone_items[position-1]
@@ -505,6 +729,7 @@ class Zone:
         else:
             if self.gui_id == id:
                 self.is_active = is_active
+                self.touch()
                 tasks_auditor.info(f"Device {self.name} made avtive: {is_active} ")
                 return True
         return  False
@@ -528,15 +753,29 @@ class Zone:
         return False
     
     def get_item_by_line_code_zone_type(self,barcode,zone_type=None):
-        if self.subzones:
-            for subzone in self.subzones:
-                if zone_type is None or subzone.zone_type is None or  subzone.zone_type == zone_type:
-                    item= subzone.get_item_by_line_code_zone_type(barcode,zone_type)
-                    if item:
-                        return item
-        else:
-            if zone_type is None  or self.zone_type is None or  self.zone_type == zone_type:
-                for item in self.zone_items:
-                    if item.content and item.content.line_code == barcode:
-                        return item
-        return None
+        items=[item for item in vial_manager.get_items_by_code(barcode) if self.holds_item(item,zone_type)]
+        return min(items,key=self.get_item_order,default=None)
+
+    def holds_item(self,item:ZoneItem,zone_type=None)->bool:
+        # items of the leaf zones under this zone, when all zones on the way allow the zone type
+        zone=item.zone
+        if zone is None or zone.subzones:
+            return False
+        zones=[]
+        while zone is not self:
+            if zone is None:
+                return False
+            zones.append(zone)
+            zone=zone.parent
+        if not self.subzones:
+            zones.append(self)
+        return zone_type is None or all(zone.zone_type is None or zone.zone_type == zone_type for zone in zones)
+
+    def get_item_order(self,item:ZoneItem):
+        # subzone and item indexes from this zone down to the item
+        order=[item.index]
+        zone=item.zone
+        while zone is not self:
+            order.append(zone.parent.subzones.index(zone))
+            zone=zone.parent
+        return order[::-1]
@@ -0,0 +1,68 @@
+import asyncio
+from collections import deque
+import json
+from configuration import app_data
+
+class ZoneEvents:
+    """
+    Change events of the zones, streamed to the GUI clients.
+    Every event has an increasing sequence number and the last ones are kept,
+    so a client reconnecting with the last number it saw only gets what it missed.
+    A reset event tells the client to fetch the full state again.
+    """
+    def __init__(self):
+        self.seq = 0
+        self.events: deque = deque(maxlen=app_data.event_buffer_size) # (seq, encoded event)
+        self.subscribers: set[asyncio.Queue] = set()
+        self.paused = False
+
+    def is_active(self) -> bool:
+        return app_data.zone_events and not self.paused
+
+    def publish(self, type: str, **data):
+        if not self.is_active():
+            return
+        self.seq += 1
+        # encoded once for all the clients, later changes of the vials do not leak into it
+        event = json.dumps({"seq": self.seq, "type": type, **data})
+        self.events.append((self.seq, event))
+        for queue in self.subscribers:
+            if queue.full():
+                self.overflow(queue)
+            else:
+                queue.put_nowait(event)
+
+    def overflow(self, queue: asyncio.Queue):
+        # a client too slow to keep up starts over with the full state
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(json.dumps({"seq": self.seq, "type": "reset"}))
+
+    def subscribe(self, since: int = None) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=app_data.event_buffer_size)
+        if since is not None:
+            if since < self.seq - len(self.events) or since > self.seq:
+                self.overflow(queue)
+            else:
+                for seq, event in self.events:
+                    if seq > since:
+                        queue.put_nowait(event)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def pause(self):
+        # bulk changes like a restart are not streamed one by one
+        self.paused = True
+
+    def reset(self):
+        self.paused = False
+        self.events.clear()
+        self.publish("reset")
+
+    def get_stats(self):
+        return {"seq": self.seq, "buffered": len(self.events), "subscribers": len(self.subscribers)}
+
+zone_events: ZoneEvents = ZoneEvents()
@@ -2,6 +2,7 @@ from dataclasses import dataclass
 from enum import Enum
 from configuration import ZoneTransition
 from vial import Vial
+from vial_manager import vial_manager
 
 class ZoneItem:
     
@@ -26,17 +27,45 @@ class ZoneItem:
             
         self.color =None        
         self.transit=None
+        self.zone:'Zone' =None # owning zone, set by the zone
+        self.index:int =0 # index in the zone items of the owning zone
+        self.counted_color =None # content color counted in the zone color counts
     
     def set_content(self, content:Vial):
+        was_empty=self.content is None
+        if self.content is not None:
+            vial_manager.remove_item(self.content,self)
         self.content=content
+        if content is not None:
+            vial_manager.set_item(content,self)
+        if self.zone:
+            self.zone.update_item(self,was_empty)
     
     def remove_content(self):
+        was_empty=self.content is None
+        if self.content is not None:
+            vial_manager.remove_item(self.content,self)
         self.content=None
+        if self.zone:
+            self.zone.update_item(self,was_empty)
     
+    def get_slot_key(self):
+        return (self.transit,self.color,tuple(self.types) if self.types else None)
+
+    def set_slot(self,color,types):
+        if self.zone and self.content is None:
+            self.zone.remove_free_slot(self)
+        self.color=color
+        self.types=types
+        if self.zone:
+            if self.content is None:
+                self.zone.add_free_slot(self)
+            self.zone.touch()
+
     def matches(self, transition:ZoneTransition):
-        return ((self.transit is None or not transition.transits or self.transit in transition.transits) and
-            (self.color is None or not transition.colors or self.color in transition.colors) and
-            (not self.types or not transition.types or any(type in transition.types for type in self.types))) 
+        return ((self.transit is None or not transition.transit_set or self.transit in transition.transit_set) and
+            (self.color is None or not transition.color_set or self.color in transition.color_set) and
+            (not self.types or not transition.type_set or not transition.type_set.isdisjoint(self.types))) 
     
     def export_data(self,is_gui):
         return {"position":self.position ,"content": self.content.export_data(is_gui)}
\ No newline at end of file
@@ -1,20 +1,34 @@
 import asyncio
 from collections import Counter
 from datetime import datetime, timedelta,time
-from functools import partial
 import inspect
+import json
+import os
 from random import choice, randint
+from time import perf_counter
 from typing import Dict
-from data_manager import read_from_file, write_to_file
-from futures_manager import futures_manager
-from vial import Vial
+from data_manager import read_bytes_from_file, read_from_file, write_to_file
+from snapshot_format import SnapshotError, decode_snapshot, encode_snapshot
+from state_journal import state_journal, state_writer
+from futures_manager import FutureCommand, futures_manager
+from zone_events import zone_events
+from vial import Vial, parse_time
 from zone import Zone
 from configuration import COLORS, VIAL_TYPE, ResponseData, ZonePhase, ZoneTransition,ItemType,TaskType,config,app_data,tasks_q,ErrorCodes
 from vial_manager import vial_manager
 from pallet import get_waypoints
+from task_queue import TaskPriority
 from event_tracker import tasks_auditor,error_auditor
 from zone_item import ZoneItem
 
+# zones whose results are reported by the robot after the move, no lookahead planning for moves into them
+CAMERA_ZONES =(2,14)
+
+def time_dependent(func):
+    # marks a hook depending on the time, transitions using it are re-evaluated on every call
+    func.time_dependent=True
+    return func
+
 class ZoneManager:
     
     def __init__(self, config_data):
@@ -26,37 +40,304 @@ class ZoneManager:
         self.centri_batch_count=0
         self.xn_batch_count=0
         self.file_loaded=False
+        self.state_loaded=True # false after a failed import, no tasks are planned on the empty zones
         self.camera1_lock = asyncio.Lock()
+        self.restore_timings:Dict[int, float]={} # ms to restore each stateful zone at the last import
+        state_writer.save=self.save_data
+        for name in ("check_vial","move_vial","move_zone","start_zone","stop_zone","set_door","init_zone","save_state"):
+            futures_manager.register_handler(name,getattr(self,f"apply_{name}"))
+        for transition in self.zone_transitions.values():
+            self.compile_hooks(transition)
+        self.unfiltered_transitions:set[int] =self.get_unfiltered_transitions()
+        self.transition_zones:Dict[int, list[Zone]] ={id: self.get_transition_zones(transition) for id,transition in self.zone_transitions.items()}
+        self.failed_transitions:Dict[tuple, tuple] ={}
+        self.lookaheads:Dict[int, tuple] ={} # robot_id: (random_id, planning task)
+        self.epoch:int =int(datetime.now().timestamp()) # start of the run, sent with the data versions
+        self.encoded_data:Dict[bool, tuple] ={} # archiv only: (data version, JSON body)
+        self.plant_changed =asyncio.Event() # set on any zone or sensor change, wakes the waiting get_task calls
+        Zone.change_listener=self.plant_changed.set
+        app_data.change_listener=self.plant_changed.set
 
     def progress_transition_order(self):
         self.current_transition_id =(self.current_transition_id % len(self.transitions_order_list)) +1
         self.transition_order= self.transitions_order_list.get(self.current_transition_id)
 
+    def compile_chain(self,transition:ZoneTransition,names):
+        if names is None: return None
+        chain=[]
+        unknown=[]
+        for name in names:
+            func = getattr(self, name, None)
+            if not callable(func):
+                unknown.append(name)
+                continue
+            chain.append((func,inspect.iscoroutinefunction(func)))
+        if unknown:
+            raise ValueError(f"Unknown functions {unknown} configured for transition {transition.transition_id}")
+        return chain
+
+    def compile_hooks(self,transition:ZoneTransition):
+        transition.pre_checks_chain =self.compile_chain(transition,transition.pre_checks)
+        transition.pre_operations_chain =self.compile_chain(transition,transition.pre_operations)
+        transition.pre_tasks_chain =self.compile_chain(transition,transition.pre_tasks)
+        transition.post_operations_chain =self.compile_chain(transition,transition.post_operations)
+        chains=(transition.pre_checks_chain,transition.pre_operations_chain,transition.pre_tasks_chain)
+        transition.time_dependent =bool(transition.disposable) or any(getattr(func,'time_dependent',False) for chain in chains for func,_ in chain or [])
+
+    def get_unfiltered_transitions(self):
+        # transitions which can change the state even if the phases are not matching, are always evaluated
+        ids=set()
+        for transition in self.zone_transitions.values():
+            curr_zone = self.get_zone(transition.curr_zone_id)
+            next_zone = self.get_zone(transition.next_zone_id)
+            if (curr_zone is None or next_zone is None or transition.pre_operations or transition.possible_next_trans_ids
+                or (not transition.curr_phases and curr_zone.has_subzones())):
+                ids.add(transition.transition_id)
+        return ids
+
+    def is_transition_candidate(self,transition:ZoneTransition):
+        if transition.transition_id in self.unfiltered_transitions:
+            return True
+        curr_zone = self.get_zone(transition.curr_zone_id)
+        next_zone = self.get_zone(transition.next_zone_id)
+        #start and stop tasks are prepared for the current zone of every transition
+        if curr_zone.has_phase([ZonePhase.READY_TO_START,ZonePhase.READY_TO_STOP]):
+            return True
+        return curr_zone.has_phase(transition.curr_phases) and next_zone.has_phase(transition.next_phases)
+
+    def get_transition_zones(self,transition:ZoneTransition):
+        transitions=[transition]
+        for id in transition.possible_next_trans_ids or []:
+            if self.get_transition(id):
+                transitions.append(self.get_transition(id))
+        zone_ids={zone_id for t in transitions for zone_id in (t.curr_zone_id,t.next_zone_id,t.target_zone_id) if zone_id is not None}
+        return [self.get_zone(zone_id) for zone_id in zone_ids if self.get_zone(zone_id)]
+
+    def get_transition_state(self,transition:ZoneTransition):
+        # hooks can read any zone, so transitions with hooks depend on the state of all zones
+        if transition.pre_checks or transition.pre_operations or transition.pre_tasks:
+            zones_state=Zone.state_version
+        else:
+            zones_state=tuple(zone.version for zone in self.transition_zones[transition.transition_id])
+        return (zones_state,app_data.sensors_version,futures_manager.executed_count)
+
+    def is_transition_unchanged(self,transition:ZoneTransition,robot_id:int):
+        state=self.failed_transitions.get((robot_id,transition.transition_id))
+        return state is not None and state == self.get_transition_state(transition)
+
+    def update_failed_transition(self,transition:ZoneTransition,robot_id:int,state:tuple):
+        # only remember the failure if the evaluation itself did not change anything
+        if not transition.time_dependent and state == self.get_transition_state(transition):
+            self.failed_transitions[(robot_id,transition.transition_id)]=state
+        else:
+            self.failed_transitions.pop((robot_id,transition.transition_id),None)
+
     def get_zone(self, zone_id):
         return self.zones.get(zone_id)
     
     def get_transition(self,id):
         return self.zone_transitions.get(id)
     
+    async def plan_task(self,robot_id):
+        if tasks_q[robot_id] or not self.state_loaded:
+            return
+        if self.centri_batch_count ==1:
+            self.progress_transition_order()
+            self.centri_batch_count=0
+        if self.xn_batch_count ==1:
+            self.progress_transition_order()
+            self.xn_batch_count=0
+        if await self.check_capacity(robot_id) and not await self.prepare_init_tasks(robot_id):
+            for transition_id in self.transition_order[robot_id]: 
+                transition=self.get_transition(transition_id)
+                if not self.is_transition_candidate(transition) or self.is_transition_unchanged(transition,robot_id):
+                    continue
+                state=self.get_transition_state(transition)
+                if await self.prepare_task(transition,robot_id):
+                    self.failed_transitions.pop((robot_id,transition_id),None)
+                    break
+                self.update_failed_transition(transition,robot_id,state)
+
     async def get_task(self,robot_id):        
-        if not tasks_q[robot_id]:
-            if self.centri_batch_count ==1:
-                self.progress_transition_order()
-                self.centri_batch_count=0
-            if self.xn_batch_count ==1:
-                self.progress_transition_order()
-                self.xn_batch_count=0
-            if await self.check_capacity(robot_id):
-                for transition_id in self.transition_order[robot_id]: 
-                    transition=self.get_transition(transition_id)
-                    if await self.prepare_task(transition,robot_id):
-                        break
-        if tasks_q[robot_id]:
-            task= tasks_q[robot_id].pop(0)
+        await self.plan_task(robot_id)
+        if tasks_q[robot_id] and self.state_loaded:
+            task= tasks_q[robot_id].pop()
             tasks_auditor.info(f"Task:{task}")
+            await self.save_futures()
             return vars(task)
         return vars(ResponseData())
     
+    def get_plant_state(self):
+        return (Zone.state_version,app_data.sensors_version,futures_manager.executed_count)
+
+    async def wait_task(self,robot_id,timeout):
+        """
+        Long polling get_task. When nothing can be planned it waits for a change of the plant,
+        e.g. a run time elapsing, a sensor or a camera result, and plans again until the timeout.
+        """
+        loop=asyncio.get_running_loop()
+        deadline=loop.time()+min(timeout,app_data.task_wait_timeout)
+        while True:
+            task=await self.get_task(robot_id)
+            remaining=deadline-loop.time()
+            if task['curr_task'] or remaining <= 0:
+                return task
+            # changes made by the planning itself do not count
+            self.plant_changed.clear()
+            try:
+                await asyncio.wait_for(self.plant_changed.wait(),min(remaining,app_data.task_wait_recheck))
+            except asyncio.TimeoutError:
+                if deadline-loop.time() <= 0:
+                    return task
+
+    def start_lookahead(self,task:dict,robot_id:int):
+        # plans the next task while the robot executes a move, assuming the move succeeds
+        if not app_data.lookahead_planning or robot_id in self.lookaheads:
+            return
+        if task['curr_task'] != TaskType.UNLOAD.value or task['next_zone'] in CAMERA_ZONES or tasks_q[robot_id]:
+            return
+        self.lookaheads[robot_id]=(task['random_id'],asyncio.create_task(self.plan_lookahead(task['random_id'],robot_id)))
+        # a robot not reporting any more does not hold the state writes for good
+        asyncio.get_running_loop().call_later(app_data.lookahead_timeout,
+                                              lambda: asyncio.create_task(self.expire_lookahead(robot_id,task['random_id'])))
+
+    async def plan_lookahead(self,random_id:int,robot_id:int):
+        """
+        Applies the future before the robot reports it and plans the next task.
+        The changed values are kept to undo them, and nothing is written until the robot confirms the move.
+        Returns the plant state, the undo and the random ids of the tasks added by the move and by the planning.
+        """
+        await state_writer.suspend()
+        commands=futures_manager.futures.get(random_id)
+        zones=self.get_command_zones(commands or [])
+        checkpoint=self.get_checkpoint(zones)
+        queued=tasks_q[robot_id].get_random_ids()
+        move_ids=set()
+        try:
+            await futures_manager.execute_future(random_id)
+            # e.g. closing a door after the move, kept when only the planning is repeated
+            move_ids=tasks_q[robot_id].get_random_ids()-queued
+            await self.plan_task(robot_id)
+        except Exception as e:
+            error_auditor.error(f"Lookahead planning failed for random id:{random_id}: {e}")
+        planned_ids=tasks_q[robot_id].get_random_ids()-queued-move_ids
+        return self.get_plant_state(),(commands,self.get_changes(checkpoint,zones)),move_ids,planned_ids
+
+    async def check_lookahead(self,random_id:int,robot_id:int):
+        # the precomputed task is kept only if the robot reports the expected move and nothing changed since
+        if robot_id not in self.lookaheads:
+            return
+        expected_id,lookahead=self.lookaheads.pop(robot_id)
+        state,undo,move_ids,planned_ids=await lookahead
+        try:
+            if random_id == expected_id and state == self.get_plant_state():
+                return
+            if random_id == expected_id:
+                # the expected move was done, only the planning is repeated
+                self.discard_planned_tasks(robot_id,planned_ids)
+            else:
+                self.discard_planned_tasks(robot_id,move_ids|planned_ids)
+                await self.undo_lookahead(expected_id,undo)
+            tasks_auditor.info(f"Lookahead for random id:{expected_id} discarded, reported random id:{random_id}")
+        finally:
+            state_writer.resume()
+
+    async def discard_lookaheads(self):
+        for robot_id in list(self.lookaheads):
+            await self.discard_lookahead(robot_id)
+
+    async def expire_lookahead(self,robot_id:int,random_id:int):
+        if robot_id in self.lookaheads and self.lookaheads[robot_id][0] == random_id:
+            tasks_auditor.warning(f"Lookahead for random id:{random_id} not confirmed by robot:{robot_id} in {app_data.lookahead_timeout}s")
+            await self.discard_lookahead(robot_id)
+
+    async def discard_lookahead(self,robot_id:int):
+        expected_id,lookahead=self.lookaheads.pop(robot_id)
+        _,undo,move_ids,planned_ids=await lookahead
+        try:
+            self.discard_planned_tasks(robot_id,move_ids|planned_ids)
+            await self.undo_lookahead(expected_id,undo)
+        finally:
+            state_writer.resume()
+
+    async def undo_lookahead(self,random_id:int,undo:tuple):
+        commands,changes=undo
+        self.undo_changes(changes)
+        if commands is not None:
+            futures_manager.restore_future(random_id,commands)
+        if changes:
+            await self.export_data(None,None,None,None)
+        tasks_auditor.info(f"Lookahead for random id:{random_id} undone, changes: {len(changes)}")
+
+    def get_command_zones(self,commands):
+        # zones whose items the commands change
+        return [self.get_zone_by_path(command.args[key]) for command in commands
+                for key in ("zone","subzone","curr_zone","next_zone") if key in command.args]
+
+    def get_checkpoint(self,zones):
+        """
+        Values a move and the planning after it can change, by (object id, field).
+        The fields of all the zones are kept, the items and vials only of the given zones,
+        so the cost does not grow with the archives.
+        """
+        checkpoint={}
+        def add(obj,field):
+            value=getattr(obj,field)
+            checkpoint[(id(obj),field)]=(obj,list(value) if isinstance(value,list) else value)
+        add(self,"centri_batch_count")
+        add(self,"xn_batch_count")
+        subzones=list(self.zones.values())
+        while subzones:
+            zone=subzones.pop()
+            subzones.extend(zone.subzones)
+            for field in Zone.checkpoint_fields:
+                add(zone,field)
+        for zone in zones:
+            for item in zone.zone_items:
+                add(item,"content")
+                if item.content:
+                    for field in vars(item.content):
+                        add(item.content,field)
+        return checkpoint
+
+    def get_changes(self,checkpoint,zones):
+        # (object, field, value before, value after) of everything changed since the checkpoint
+        changes=[]
+        for key,(obj,value) in self.get_checkpoint(zones).items():
+            if key in checkpoint and not self.is_same_value(field:=key[1],checkpoint[key][1],value):
+                changes.append((obj,field,checkpoint[key][1],value))
+        return changes
+
+    def is_same_value(self,field,value,other):
+        # the content of an item is the vial itself, not an equal one
+        return value is other or (field != "content" and value == other)
+
+    def undo_changes(self,changes):
+        for obj,field,before,after in reversed(changes):
+            # changed again since, e.g. by a camera result, the later change is kept
+            if not self.is_same_value(field,getattr(obj,field),after):
+                continue
+            if isinstance(obj,ZoneItem):
+                obj.set_content(before)
+            elif isinstance(obj,Zone) and field == "phase":
+                obj.set_zone_phase(before)
+            elif isinstance(obj,Zone) and field == "door_opened":
+                obj.set_door(before)
+            elif isinstance(obj,Vial) and field == "current_zone_id":
+                obj.set_zone(before)
+            elif isinstance(obj,Vial) and field == "current_subzone_id":
+                obj.set_subzone(before)
+            elif isinstance(obj,Vial) and field == "line_code":
+                vial_manager.set_line_code(obj,before)
+            else:
+                setattr(obj,field,before)
+                if isinstance(obj,Zone):
+                    obj.touch()
+
+    def discard_planned_tasks(self,robot_id:int,random_ids:set):
+        for task in tasks_q[robot_id].remove(random_ids):
+            futures_manager.discard_future(task.random_id)
+
     async def get_test_task(self,robot_id): 
         return vars(ResponseData(curr_zone=21, next_zone=0, curr_subzone=21, next_subzone=0, curr_wp={'x': 0, 'y': 0, 'z': 0, 'rx': 0, 'ry': 0, 'rz': 0}, next_wp={'x': 0, 'y': 0, 'z': 0, 'rx': 0, 'ry': 0, 'rz': 0}, curr_task=5, next_task=0, item_type=0, vial_type=0, random_id=4680924, color=0, decapped=0, curr_idx=0, next_idx=0))
         return vars(ResponseData(curr_zone=12, next_zone=13, curr_subzone=1, next_subzone=1, curr_wp={'x': 0, 'y': 0, 'z': 0, 'rx': 0, 'ry': 0, 'rz': 0}, next_wp={'x': 0, 'y': 0, 'z': 0, 'rx': 0, 'ry': 0, 'rz': 0}, curr_task=2, next_task=1, item_type=2, vial_type=5, random_id=1413435, color=8, decapped=0))
@@ -83,7 +364,7 @@ class ZoneManager:
             raise "Invalid zone ids configured"
         
         # pre operation to be performed 
-        await self.execute_func(transition.pre_operations,transition,curr_subzone or curr_zone,next_subzone or next_zone,robot_id)
+        await self.execute_func(transition.pre_operations_chain,transition,curr_subzone or curr_zone,next_subzone or next_zone,robot_id)
 
         if curr_zone.has_subzones():
             curr_subzone=curr_zone.get_subzone_to_pick(transition)
@@ -106,7 +387,7 @@ class ZoneManager:
         curr_subzone, curr_item = curr_zone.get_subzone_and_item(transition)  
         next_subzone, next_item = next_zone.get_subzone_and_empty_item(transition) 
 
-        if not await self.execute_func(transition.pre_checks,transition,curr_subzone or curr_zone,next_subzone or next_zone,robot_id):            
+        if not await self.execute_func(transition.pre_checks_chain,transition,curr_subzone or curr_zone,next_subzone or next_zone,robot_id):            
             return None 
         
         if tasks_q[robot_id]:
@@ -132,7 +413,7 @@ class ZoneManager:
                     result =True
                 return result        
         
-        random_id= randint(1000000, 9999999)
+        random_id= futures_manager.next_id()
         curr_type= curr_item.content.type if curr_item and curr_item.content and curr_item.content.type else 1
         color= curr_item.content.color if curr_item and curr_item.content and curr_item.content.color else 0
         decapped =1 if curr_item and curr_item.content and curr_item.content.decapped else 0
@@ -160,27 +441,24 @@ class ZoneManager:
 
         if transition.item_type == ItemType.ZONE:
             futures_manager.register_future(random_id,[
-            lambda: curr_subzone.move_to_zone(next_zone,next_subzone,transition.item_type),
-            lambda: curr_subzone.set_zone_phase(curr_subzone.get_next_phase()),
-            lambda: next_subzone.set_zone_phase(next_subzone.get_next_phase()),            
-            lambda: tasks_auditor.info(f"Zone moved from {curr_subzone.name} , type: {curr_subzone.zone_type} to {next_subzone.name} , type: {curr_subzone.zone_type},transition_id: {transition.transition_id}"),
-            partial(self.execute_post_operations,transition,curr_subzone,next_subzone,robot_id)])
+            FutureCommand("move_zone",{"transition_id":transition.transition_id,"robot_id":robot_id,
+                                       "curr_zone":self.get_zone_path(curr_subzone),"next_zone":self.get_zone_path(next_subzone)})])
         else:
-            futures_manager.register_future(random_id,[
-            lambda: tasks_auditor.info(f"Robot:{robot_id} {emergency} Vial code: {line_code}, transit: {curr_item.content.transits[0] if curr_item.content and curr_item.content.transits else None}, color: {COLORS.get(color, f'Color:{color}') if color else None} ,type: {VIAL_TYPE.get(curr_type, f'Type:{curr_type}') if curr_type else ''} moved from {curr_subzone.name} - position: {curr_item.position} to {next_subzone.name} -position: {next_item.position},transition_id: {transition.transition_id}"),
-            lambda: curr_item.content and curr_item.content.set_zone(next_zone.zone_id),
-            lambda: curr_item.content and curr_item.content.set_subzone(next_subzone.zone_id),
-            lambda: curr_item.content and curr_item.content.set_next_zone(None)    , 
-            lambda: next_item.set_content(curr_item.content),
-            lambda: curr_item.remove_content(),
-            lambda: self.update_zone_phases(curr_subzone,next_subzone,transition),
-            partial(self.execute_post_operations,transition,curr_subzone,next_subzone,robot_id)
-            ])
+            commands=[]
+            if curr_item.content:
+                commands.append(FutureCommand("check_vial",{"zone":self.get_zone_path(curr_subzone),"index":curr_item.index,"line_code":curr_item.content.line_code}))
+            commands.append(FutureCommand("move_vial",{"transition_id":transition.transition_id,"robot_id":robot_id,
+                                       "curr_zone":self.get_zone_path(curr_subzone),"curr_index":curr_item.index,
+                                       "next_zone":self.get_zone_path(next_subzone),"next_index":next_item.index,
+                                       "line_code":line_code,"color":color,"curr_type":curr_type,"emergency":emergency,
+                                       # the source is empty after a restart when it is not persisted, the vial is placed from here
+                                       "vial":curr_item.content.export_data(False) if curr_item.content and not curr_subzone.is_stateful() else None}))
+            futures_manager.register_future(random_id,commands)
 
         # pre tasks like close door /open door 
-        await self.execute_func(transition.pre_tasks,transition,curr_subzone or curr_zone,next_subzone or next_zone,robot_id)
+        await self.execute_func(transition.pre_tasks_chain,transition,curr_subzone or curr_zone,next_subzone or next_zone,robot_id)
 
-        tasks_q[robot_id].append(result)
+        tasks_q[robot_id].put(result,TaskPriority.EMERGENCY if emergency else TaskPriority.NORMAL)
         return True    
     
     async def prepare_start_task(self,curr_zone_id: int,robot_id:int):
@@ -193,7 +471,7 @@ class ZoneManager:
         else:
             if  not curr_zone.is_ready_to_start():
                 return None
-        random_id= randint(1000000, 9999999)
+        random_id= futures_manager.next_id()
         result = ResponseData(
             curr_zone=curr_zone.zone_id, 
             curr_subzone=curr_subzone.zone_id if curr_subzone else 0,
@@ -201,15 +479,12 @@ class ZoneManager:
             random_id=random_id
             )  
         if curr_zone_id == 21:
-            curr_subzone.door_opened =False 
+            curr_subzone.set_door(False)
         if curr_zone_id == 8:
             self.update_xn_count(None,None,None,1)
-        zone=curr_subzone or curr_zone  
-        futures_manager.register_future(random_id,[ 
-        partial(curr_subzone.start_zone,curr_zone),
-        lambda:curr_subzone.initialize(False),
-        lambda: tasks_auditor.info(f"{curr_subzone.name} started.. with {curr_subzone.get_count() } tubes")])
-        tasks_q[robot_id].append(result)
+        futures_manager.register_future(random_id,[
+        FutureCommand("start_zone",{"zone":self.get_zone_path(curr_zone),"subzone":self.get_zone_path(curr_subzone)})])
+        tasks_q[robot_id].put(result,TaskPriority.MACHINE)
         return True
     
     async def prepare_stop_task(self, transition: ZoneTransition,robot_id:int):
@@ -221,40 +496,34 @@ class ZoneManager:
         if curr_zone.subzones:
             for subzone in curr_zone.subzones:
                 if subzone.is_ready_to_stop():           
-                    if not await self.execute_func(transition.pre_checks,transition,subzone,None,robot_id):            
+                    if not await self.execute_func(transition.pre_checks_chain,transition,subzone,None,robot_id):            
                         continue         
-                    random_id= randint(1000000, 9999999)
+                    random_id= futures_manager.next_id()
                     result = ResponseData(
                         curr_zone=curr_zone.zone_id, 
                         curr_subzone=subzone.zone_id if subzone else 0,
                         curr_task=TaskType.STOP.value,
                         random_id=random_id
                         )  
-                    futures_manager.register_future(random_id,[       
-                    lambda: subzone.set_zone_phase(subzone.get_next_phase()),
-                    lambda:subzone.initialize(False),
-                    lambda: tasks_auditor.info(f"{subzone.name} stopped..")])
-                    tasks_q[robot_id].append(result)
+                    futures_manager.register_future(random_id,[FutureCommand("stop_zone",{"zone":self.get_zone_path(subzone)})])
+                    tasks_q[robot_id].put(result,TaskPriority.MACHINE)
                     return True
             
         elif curr_zone.is_ready_to_stop():
-            if not await self.execute_func(transition.pre_checks,transition,curr_zone,None,robot_id):            
+            if not await self.execute_func(transition.pre_checks_chain,transition,curr_zone,None,robot_id):            
                     return None
-            random_id= randint(1000000, 9999999)
+            random_id= futures_manager.next_id()
             result = ResponseData(
                 curr_zone=curr_zone.zone_id, 
                 curr_task=TaskType.STOP.value,
                 random_id=random_id
                 )
-            futures_manager.register_future(random_id,[       
-            lambda: curr_zone.set_zone_phase(curr_zone.get_next_phase()),
-            lambda:curr_zone.initialize(False),
-            lambda: tasks_auditor.info(f"{curr_zone.name} stopped..")])
-            tasks_q[robot_id].append(result)
+            futures_manager.register_future(random_id,[FutureCommand("stop_zone",{"zone":self.get_zone_path(curr_zone)})])
+            tasks_q[robot_id].put(result,TaskPriority.MACHINE)
             return True
         
     def prepare_doors_task(self, curr_zone:Zone,curr_subzone:Zone,open:bool,robot_id:int):
-        random_id= randint(1000000, 9999999)
+        random_id= futures_manager.next_id()
         result = ResponseData(
             curr_zone=curr_zone.zone_id, 
             curr_subzone=curr_subzone.zone_id if curr_subzone else 0,
@@ -262,16 +531,13 @@ class ZoneManager:
             random_id=random_id
             )
         zone=curr_subzone or curr_zone  
-        futures_manager.register_future(random_id,[ 
-        lambda:zone.set_door(open),
-        lambda: zone.set_zone_phase(zone.get_next_phase()),
-        partial(self.export_data,None,None,None,None),
-        lambda: tasks_auditor.info(f"{zone.name} Door {"Opened.." if open else "Closed.."} ")])        
-        tasks_q[robot_id].append(result)
+        futures_manager.register_future(random_id,[
+        FutureCommand("set_door",{"zone":self.get_zone_path(zone),"open":open,"progress":True})])
+        tasks_q[robot_id].put(result,TaskPriority.SAFETY)
         return True
     
     def prepare_doors_task_no_progress(self, curr_zone:Zone,curr_subzone:Zone,open:bool,robot_id:int):
-        random_id= randint(1000000, 9999999)
+        random_id= futures_manager.next_id()
         result = ResponseData(
             curr_zone=curr_zone.zone_id, 
             curr_subzone=curr_subzone.zone_id if curr_subzone else 0,
@@ -279,25 +545,21 @@ class ZoneManager:
             random_id=random_id
             )
         zone=curr_subzone or curr_zone  
-        futures_manager.register_future(random_id,[ 
-        lambda:zone.set_door(open),
-        partial(self.export_data,None,None,None,None),
-        lambda: tasks_auditor.info(f"{zone.name} Door {"Opened.." if open else "Closed.."} ")])        
-        tasks_q[robot_id].append(result)
+        futures_manager.register_future(random_id,[
+        FutureCommand("set_door",{"zone":self.get_zone_path(zone),"open":open,"progress":False})])
+        tasks_q[robot_id].put(result,TaskPriority.SAFETY)
         return True
 
     
     async def prepare_pause_task(self, curr_zone:Zone,robot_id:int):
-        random_id= randint(1000000, 9999999)
+        random_id= futures_manager.next_id()
         result = ResponseData(
             curr_zone=curr_zone.zone_id, 
             curr_task=TaskType.PAUSE.value,
             random_id=random_id
             )
-        zone=curr_zone  
-        futures_manager.register_future(random_id,[
-        partial(self.export_data,None,None,None,None)])
-        tasks_q[robot_id].append(result)
+        futures_manager.register_future(random_id,[FutureCommand("save_state")])
+        tasks_q[robot_id].put(result,TaskPriority.SAFETY)
         return True
     
     # To progreess the zones to next phases
@@ -379,11 +641,9 @@ class ZoneManager:
 
             
     async def execute_func(self,funcs,transition:ZoneTransition,cuur_zone:Zone,next_zone:Zone,robot_id:int):
-        if funcs is None: return True
-        for func in funcs:
-            func = getattr(self, func, None)
-            if not func: return True
-            if inspect.iscoroutinefunction(func):
+        if not funcs: return True
+        for func,is_async in funcs:
+            if is_async:
                 result= await func(transition,cuur_zone,next_zone,robot_id)
             else:
                 result= func(transition,cuur_zone,next_zone,robot_id)
@@ -393,16 +653,115 @@ class ZoneManager:
     
     async def execute_post_operations(self,transition:ZoneTransition,cuur_zone:Zone,next_zone:Zone,robot_id:int):
         result =True
-        if transition.post_operations is None: return True
-        for func in transition.post_operations:
-            func = getattr(self, func, None)
-            if not func: continue
-            if inspect.iscoroutinefunction(func):
+        if transition.post_operations_chain is None: return True
+        for func,is_async in transition.post_operations_chain:
+            if is_async:
                 result= await func(transition,cuur_zone,next_zone,robot_id)
             else:
                 result= func(transition,cuur_zone,next_zone,robot_id)
         return result
     
+    # region future commands, applied when the robot reports the task
+
+    def get_zone_path(self,zone:Zone):
+        # zone id followed by the subzone indexes, the same across restarts
+        path=[]
+        while zone.parent:
+            path.append(zone.parent.subzones.index(zone))
+            zone=zone.parent
+        return [zone.zone_id]+path[::-1]
+
+    def get_zone_by_path(self,path):
+        zone=self.get_zone(path[0])
+        for index in path[1:]:
+            zone=zone.subzones[index]
+        return zone
+
+    def apply_check_vial(self,zone,index,line_code):
+        item:ZoneItem=self.get_zone_by_path(zone).zone_items[index]
+        if item.content is None and futures_manager.replaying and not item.zone.is_stateful():
+            return True
+        if item.content is None or item.content.line_code != line_code:
+            error_auditor.error(f"Vial code: {line_code} not found in {item.zone.name} - position: {item.position}")
+            return False
+        return True
+
+    async def apply_move_vial(self,transition_id,robot_id,curr_zone,curr_index,next_zone,next_index,line_code,color,curr_type,emergency,vial=None):
+        transition=self.get_transition(transition_id)
+        curr_subzone=self.get_zone_by_path(curr_zone)
+        next_subzone=self.get_zone_by_path(next_zone)
+        curr_item:ZoneItem=curr_subzone.zone_items[curr_index]
+        next_item:ZoneItem=next_subzone.zone_items[next_index]
+        if vial and curr_item.content is None and futures_manager.replaying:
+            curr_item.set_content(Vial(**json.loads(vial)))
+            vial_manager.add_vial(curr_item.content)
+            tasks_auditor.info(f"Vial code: {line_code} restored to {curr_subzone.name} - position: {curr_item.position} from the futures")
+        vial=curr_item.content
+        tasks_auditor.info(f"Robot:{robot_id} {emergency} Vial code: {line_code}, transit: {vial.transits[0] if vial and vial.transits else None}, color: {COLORS.get(color, f'Color:{color}') if color else None} ,type: {VIAL_TYPE.get(curr_type, f'Type:{curr_type}') if curr_type else ''} moved from {curr_subzone.name} - position: {curr_item.position} to {next_subzone.name} -position: {next_item.position},transition_id: {transition_id}")
+        if vial:
+            vial.set_zone(next_zone[0])
+            vial.set_subzone(next_subzone.zone_id)
+            vial.set_next_zone(None)
+        next_item.set_content(vial)
+        curr_item.remove_content()
+        self.update_zone_phases(curr_subzone,next_subzone,transition)
+        await self.execute_post_operations(transition,curr_subzone,next_subzone,robot_id)
+
+    async def apply_move_zone(self,transition_id,robot_id,curr_zone,next_zone):
+        transition=self.get_transition(transition_id)
+        curr_subzone=self.get_zone_by_path(curr_zone)
+        next_subzone=self.get_zone_by_path(next_zone)
+        curr_subzone.move_to_zone(self.get_zone(next_zone[0]),next_subzone,transition.item_type)
+        curr_subzone.set_zone_phase(curr_subzone.get_next_phase())
+        next_subzone.set_zone_phase(next_subzone.get_next_phase())
+        tasks_auditor.info(f"Zone moved from {curr_subzone.name} , type: {curr_subzone.zone_type} to {next_subzone.name} , type: {curr_subzone.zone_type},transition_id: {transition_id}")
+        await self.execute_post_operations(transition,curr_subzone,next_subzone,robot_id)
+
+    async def apply_start_zone(self,zone,subzone):
+        subzone=self.get_zone_by_path(subzone)
+        await subzone.start_zone(self.get_zone_by_path(zone))
+        subzone.initialize(False)
+        tasks_auditor.info(f"{subzone.name} started.. with {subzone.get_count() } tubes")
+
+    def apply_stop_zone(self,zone):
+        zone=self.get_zone_by_path(zone)
+        zone.set_zone_phase(zone.get_next_phase())
+        zone.initialize(False)
+        tasks_auditor.info(f"{zone.name} stopped..")
+
+    async def apply_set_door(self,zone,open,progress):
+        zone=self.get_zone_by_path(zone)
+        zone.set_door(open)
+        if progress:
+            zone.set_zone_phase(zone.get_next_phase())
+        await self.export_data(None,None,None,None)
+        tasks_auditor.info(f"{zone.name} Door {"Opened.." if open else "Closed.."} ")
+
+    def apply_init_zone(self,zone,reset_door):
+        zone=self.get_zone_by_path(zone)
+        if reset_door:
+            zone.set_door(False)
+            zone.set_zone_phase(ZonePhase.PRE_PROCESS)
+        zone.initialize()
+
+    async def apply_save_state(self):
+        await self.export_data(None,None,None,None)
+
+    async def save_futures(self):
+        # journaled before the task is handed out, so the robot never reports a random id the journal does not know
+        records=futures_manager.take_records(done=False)
+        if app_data.state_journal:
+            await state_journal.append(records)
+
+    async def discard_futures(self,restored_only=False):
+        count=futures_manager.discard_all(restored_only)
+        records=futures_manager.take_records()
+        if app_data.state_journal:
+            await state_journal.append(records)
+        return count
+
+    #end region
+
     async def get_archiv_data(self):
         data = []
         for zone_id in self.zones:
@@ -418,16 +777,46 @@ class ZoneManager:
             # names = zone.name
             data.append({"zone_id":zone_id,"zone": zone.export_data(True)})
         return data
+
+    def get_data_version(self,archiv:bool):
+        if archiv:
+            return max((zone.version for zone in self.zones.values() if zone.stateful),default=0)
+        return Zone.state_version
+
+    def get_encoded_data(self,archiv:bool)->bytes:
+        # the JSON body of the REST exports, encoded again only after a change
+        version=self.get_data_version(archiv)
+        cached=self.encoded_data.get(archiv)
+        if cached and cached[0] == version:
+            return cached[1]
+        data=[{"zone_id":zone_id,"zone": zone.export_data(True)} for zone_id,zone in self.zones.items() if zone.stateful or not archiv]
+        body=json.dumps(data).encode('utf-8')
+        self.encoded_data[archiv]=(version,body)
+        return body
+
+    def get_etag(self,archiv:bool):
+        # the epoch tells the versions of an earlier run apart
+        return f'"{self.epoch}-{self.get_data_version(archiv)}"'
+
+    async def get_changed_data(self,archiv:bool,since_version:int,epoch:int=None):
+        """
+        Zones changed after since_version, all of them if the version is not from this run.
+        """
+        full= since_version is None or since_version > Zone.state_version or (epoch is not None and epoch != self.epoch)
+        data = []
+        for zone_id in self.zones:
+            zone =self.zones[zone_id]
+            if (zone.stateful or not archiv) and (full or zone.version > since_version):
+                data.append({"zone_id":zone_id,"zone": zone.export_data(True)})
+        return {"epoch":self.epoch,"version":self.get_data_version(archiv),"full":full,"zones":data}
     
     async def delete_vial_by_barcode(self,barcode):
         vial=vial_manager.get_vial(barcode)
         if vial:
-            curr_zone=self.get_zone(vial.current_zone_id)
-            curr_subzone:Zone=curr_zone.get_subzone_by_id(vial.current_subzone_id)
-            item=(curr_subzone or curr_zone).get_item_by_line_code(barcode)
+            item=vial_manager.get_item(vial)
             if item:
                 item.remove_content()
-                vial_manager.delete_vial(vial)
+                vial_manager.dispose_vial(vial,"deleted via GUI")
                 tasks_auditor.info(f"Vial {vial.line_code} removed via GUI from zone: {vial.current_zone_id},sub_zone: {vial.current_subzone_id}, position: {item.position}")
                 await self.export_data(None,None,None,1)
         else:
@@ -496,9 +885,8 @@ class ZoneManager:
         orig_curr_zone= self.get_zone(orig_transition.curr_zone_id)
         orig_curr_subzone=orig_curr_zone.get_subzone_to_pick(orig_transition)
         if orig_curr_subzone is None: return
-        for vial in vial_manager.vials:
-            if vial.current_zone_id == orig_curr_zone.zone_id and vial.current_subzone_id == orig_curr_subzone.zone_id:
-                return
+        if vial_manager.get_vials_at(orig_curr_zone.zone_id,orig_curr_subzone.zone_id):
+            return
         next_zone.progress_phase()
 
     def change_to_unloading(self,transition:ZoneTransition,curr_zone:Zone,next_zone:Zone,robot_id:int):
@@ -507,9 +895,8 @@ class ZoneManager:
 
     def check_cobas_unload(self,transition:ZoneTransition,curr_zone:Zone,next_zone:Zone,robot_id:int):
         if any(item.content for item in curr_zone.zone_items):        
-            for vial in vial_manager.vials:            
-                if vial.current_zone_id == transition.curr_zone_id and vial.current_subzone_id == curr_zone.zone_id and vial.color !=6 :                
-                    return True
+            if any(vial.color !=6 for vial in vial_manager.get_vials_at(transition.curr_zone_id,curr_zone.zone_id)):
+                return True
         for item in curr_zone.zone_items:
             if item.content:
                 item.remove_content()
@@ -621,31 +1008,53 @@ class ZoneManager:
                 # move items from actual zone to the virtual zone
                 actual_subzone.move_to_zone(virtual_zone,virtual_subzone,ItemType.VIAL)
                 #move all items from temporary zone to actual zone.
-                for vial in vial_manager.vials:
-                    if vial.current_zone_id == 1000 and vial.current_subzone_id == 1000:
-                        vial.set_zone(actual_zone_id)
-                        vial.set_subzone(actual_subzone_id)
-                        next_item=actual_subzone.get_next_empty_item()
-                        next_item.set_content(vial)
+                for vial in vial_manager.get_vials_at(1000,1000):
+                    vial.set_zone(actual_zone_id)
+                    vial.set_subzone(actual_subzone_id)
+                    next_item=actual_subzone.get_next_empty_item()
+                    next_item.set_content(vial)
                 tasks_auditor.info(f"Tubes swapped between {virtual_subzone.name} and {actual_subzone.name}")
             virtual_subzone.progress_phase()               
         item.set_content(vial)  
         return True
 
     async def restart(self,archiv_reset):
+        # nothing is written between emptying the zones and importing them again,
+        # the writes stay suspended after a failed import until a restart succeeds, the state on disk is not overwritten with empty zones
+        if self.state_loaded:
+            await state_writer.suspend()
+        try:
+            self.state_loaded=False
+            await self.reload(archiv_reset)
+        except Exception as e:
+            error_auditor.error(f"Restart failed{'' if self.state_loaded else ', no tasks are planned and the state is not written until a restart succeeds'}: {e}")
+            raise
+        finally:
+            if self.state_loaded:
+                state_writer.resume()
+
+    async def reload(self,archiv_reset):
+        await self.discard_lookaheads()
+        self.failed_transitions.clear()
         self.centri_batch_count=0
         self.xn_batch_count=0
-        for zone in self.zones:
-            await self.zones[zone].restart()
-        for transition in self.zone_transitions:
-            self.zone_transitions[transition].pick_index = 0 if self.zone_transitions[transition].pick_index else None
-            self.zone_transitions[transition].place_index = 0 if self.zone_transitions[transition].place_index else None
-        self.init_counter_zone()
-        if archiv_reset:
-            await self.export_data(None,None,None,1)
-            tasks_auditor.info(f"Archive got reset")
-        await self.import_data()
-        await self.reset_controls()
+        zone_events.pause()
+        try:
+            for zone in self.zones:
+                await self.zones[zone].restart()
+            for transition in self.zone_transitions:
+                self.zone_transitions[transition].pick_index = 0 if self.zone_transitions[transition].pick_index else None
+                self.zone_transitions[transition].place_index = 0 if self.zone_transitions[transition].place_index else None
+            self.init_counter_zone()
+            if archiv_reset:
+                await self.save_data()
+                tasks_auditor.info(f"Archive got reset")
+            await self.import_data()
+            self.state_loaded=True
+            await self.reset_controls()
+        finally:
+            # the clients fetch the restored state at once
+            zone_events.reset()
     
     async def prepare_data(self,results):
         try:
@@ -671,7 +1080,7 @@ class ZoneManager:
         if not app_data.cam1_sensor:
             return
         await self.camera_capture()
-        app_data.cam1_sensor=False
+        app_data.set_cam1_sensor(False)
         return True
     
     async def camera_capture(self):
@@ -686,7 +1095,7 @@ class ZoneManager:
         if results:
             await self.prepare_data(results)
             print(results)
-        app_data.cam1_sensor=False
+        app_data.set_cam1_sensor(False)
         return True
 
     def can_unload_counter(self,transition:ZoneTransition,curr_zone:Zone,next_zone:Zone,robot_id:int):
@@ -865,21 +1274,80 @@ class ZoneManager:
         counterZone.set_item(3,Vial(line_code="1233",color=5,type=1,current_zone_id=9,next_zone_id=3))
         counterZone.set_item(4,Vial(line_code="1234",color=5,type=2,current_zone_id=9,next_zone_id=3))
 
-    async def export_data(self,transition:ZoneTransition,curr_zone:Zone,next_zone:Zone,robot_id:int):
+    def get_snapshot(self):
         data = []
         for zone_id in self.zones:
             zone =self.zones[zone_id]
             if zone.stateful:
-                data.append({"zone_id":zone_id,"zone": zone.export_data()})
-        await write_to_file(data) 
-    
+                data.append((zone_id,zone) if app_data.snapshot_format == 'binary' else {"zone_id":zone_id,"zone": zone.export_data()})
+                zone.mark_saved()
+        return encode_snapshot(data) if app_data.snapshot_format == 'binary' else data
+
+    async def export_data(self,transition:ZoneTransition,curr_zone:Zone,next_zone:Zone,robot_id:int):
+        if not app_data.snapshot_debounce and not state_writer.suspended:
+            await self.save_data()
+            return
+        state_writer.mark_dirty()
+
+    async def save_data(self):
+        if not app_data.state_journal:
+            futures_manager.take_records()
+            await write_to_file(self.get_snapshot(),state_journal.snapshot_name) 
+            return
+        # collected before any await, so the journal is written in the order of the changes
+        if state_journal.needs_snapshot():
+            await state_journal.write_snapshot(self.get_snapshot(),futures_manager.get_pending_records())
+            return
+        records = []
+        for zone_id in self.zones:
+            zone =self.zones[zone_id]
+            if zone.stateful:
+                records.extend(zone.get_journal_records(zone_id))
+        # completed futures go with the zone changes they made
+        records.extend(futures_manager.take_records())
+        await state_journal.append(records)
+    
+    async def read_snapshot(self):
+        if app_data.snapshot_format == 'binary' and os.path.exists(state_journal.snapshot_name):
+            raw_data=await read_bytes_from_file(state_journal.snapshot_name)
+            if raw_data:
+                try:
+                    return decode_snapshot(raw_data)
+                except SnapshotError as e:
+                    error_auditor.error(f"Error reading from {state_journal.snapshot_name}, the zones are not restored: {e}")
+                    raise
+            return None
+        # zones.json is also read after switching to the binary format
+        return await read_from_file()
+
     async def import_data(self):
-        data=await read_from_file()
+        data=await self.read_snapshot()
+        self.restore_timings={}
         if data:
             for zone_data in data:
                 zone_id=zone_data["zone_id"]
                 zone=self.get_zone(zone_id)
+                start=perf_counter()
                 zone.import_data(zone_data["zone"])
+                self.restore_timings[zone_id]=round((perf_counter()-start)*1000,3)
+            tasks_auditor.info(f"Zones restored in {sum(self.restore_timings.values()):.1f} ms, by zone: {self.restore_timings}")
+        records=await state_journal.read_records() if app_data.state_journal else []
+        for record in records:
+            if "future_id" in record or "last_future_id" in record:
+                futures_manager.import_record(record)
+                continue
+            zone=self.get_zone(record["zone_id"])
+            if record["subzone_id"]:
+                zone=zone.get_subzone_by_id(record["subzone_id"])
+            zone.import_record(record)
+        if records:
+            tasks_auditor.info(f"Journal replayed, records: {len(records)}")
+            await state_journal.write_snapshot(self.get_snapshot(),futures_manager.get_pending_records())
+        if futures_manager.restored:
+            tasks_auditor.info(f"Futures restored for random ids: {sorted(futures_manager.restored)}")
+        for zone_id in self.zones:
+            if self.zones[zone_id].stateful:
+                self.zones[zone_id].mark_saved()
 
     def get_vial_type(self,color):
         for mapping in app_data.color_type_map:
@@ -1076,12 +1544,11 @@ class ZoneManager:
             # move items from actual zone to the virtual zone
             actual_subzone.move_to_zone(virtual_zone,virtual_subzone,ItemType.VIAL)
             #move all items from temporary zone to actual zone.
-            for vial in vial_manager.vials:
-                if vial.current_zone_id == 1000 and vial.current_subzone_id == 1000:
-                    vial.set_zone(actual_zone_id)
-                    vial.set_subzone(actual_subzone_id)
-                    next_item=actual_subzone.get_next_empty_item()
-                    next_item.set_content(vial)
+            for vial in vial_manager.get_vials_at(1000,1000):
+                vial.set_zone(actual_zone_id)
+                vial.set_subzone(actual_subzone_id)
+                next_item=actual_subzone.get_next_empty_item()
+                next_item.set_content(vial)
             tasks_auditor.info(f"Tubes swapped between {virtual_subzone.name} and {actual_subzone.name}")
         virtual_subzone.progress_phase()
         item.set_content(vial)
@@ -1114,15 +1581,18 @@ class ZoneManager:
         if dustbin.is_in_phase([ZonePhase.LOADING]):
             for item in dustbin.zone_items:
                 if item.content:
+                    vial=item.content
                     item.remove_content()
+                    vial_manager.dispose_vial(vial,"dustbin cleared")
             dustbin.progress_phase()
 
+    @time_dependent
     async def check_disposal_time(self, transition: ZoneTransition, curr_zone: Zone, next_zone: Zone, robot_id:int):
         #return True
         disposal_time = app_data.disposal_time  # number of days
         if disposal_time:
             added_times = [
-                datetime.fromisoformat(item.content.added_time)
+                parse_time(item.content.added_time)
                 for item in curr_zone.zone_items
                 if item.content and item.content.added_time
             ]
@@ -1132,6 +1602,7 @@ class ZoneManager:
                     return True
         return False
 
+    @time_dependent
     async def check_conrols_time(self, transition: ZoneTransition, curr_zone: Zone, next_zone: Zone, robot_id:int):
         try:
             if app_data.controls_time is None:
@@ -1146,6 +1617,7 @@ class ZoneManager:
         except Exception as e:
             return False
     
+    @time_dependent
     async def is_ortho_ready_to_unload(self, transition: ZoneTransition, curr_zone: Zone, next_zone: Zone, robot_id:int):
         ortho_machine_zone: Zone = zone_manager.get_zone(21)  # Ortho Machine
         ortho_machine_subzone=ortho_machine_zone.subzones[0]
@@ -1162,6 +1634,7 @@ class ZoneManager:
             return True
         return False
     
+    @time_dependent
     async def is_ortho_ready_to_unload1(self, transition: ZoneTransition, curr_zone: Zone, next_zone: Zone, robot_id:int):
         ortho_machine_zone: Zone = zone_manager.get_zone(21)  # Ortho Machine
         ortho_machine_subzone=ortho_machine_zone.subzones[0]
@@ -1213,7 +1686,7 @@ class ZoneManager:
         return False
     
     async def reset_zone_type(self, transition: ZoneTransition, curr_zone: Zone, next_zone: Zone, robot_id:int):
-        curr_zone.zone_type=None
+        curr_zone.set_zone_type(None)
         return True
     
     async def camera1_pilots_available(self, transition: ZoneTransition, curr_zone: Zone, next_zone: Zone, robot_id:int):
@@ -1433,6 +1906,7 @@ class ZoneManager:
         await asyncio.sleep(10)
         return True
     
+    @time_dependent
     async def can_dimenstion_stop(self,transition:ZoneTransition,curr_zone:Zone,next_zone:Zone,robot_id:int):
         result=False
         try:
@@ -1463,6 +1937,7 @@ class ZoneManager:
     async def is_next_zone_active(self,transition:ZoneTransition,curr_zone:Zone,next_zone:Zone,robot_id:int):
         return next_zone.is_active
     
+    @time_dependent
     async def is_not_waiting_period(self,transition:ZoneTransition,curr_zone:Zone,next_zone:Zone,robot_id:int):
         sysmex_zone= self.get_zone(8)
         for subzone in sysmex_zone.subzones:
@@ -1488,6 +1963,7 @@ class ZoneManager:
             return False
         return self.check_controls_count(curr_zone,transition.next_zone_id)
 
+    @time_dependent
     async def is_controls_time(self, transition: ZoneTransition, curr_zone: Zone, next_zone: Zone, robot_id:int):
         current_time = datetime.now().time()
         if current_time >= app_data.controls_time:
@@ -1740,14 +2216,12 @@ class ZoneManager:
                     if curr_item and curr_item.content:
                         curr_item.content.set_subzone(zone.zone_id)    
                         curr_item.remove_content()
-                for vial in vial_manager.vials:
-                    if vial.current_zone_id == transition.next_zone_id and vial.current_subzone_id == virtual_subzone.zone_id:
-                        next_item=zone.get_next_empty_item()
-                        next_item.set_content(vial)
-                        continue
-                    if vial.current_zone_id == transition.next_zone_id and vial.current_subzone_id == zone.zone_id:
-                        next_item=virtual_subzone.get_next_empty_item()
-                        next_item.set_content(vial)
+                for vial in vial_manager.get_vials_at(transition.next_zone_id,virtual_subzone.zone_id):
+                    next_item=zone.get_next_empty_item()
+                    next_item.set_content(vial)
+                for vial in vial_manager.get_vials_at(transition.next_zone_id,zone.zone_id):
+                    next_item=virtual_subzone.get_next_empty_item()
+                    next_item.set_content(vial)
                 tasks_auditor.info(f"Samples interchanged between {zone.name} and {virtual_subzone.name}")
                 return
     
@@ -1758,7 +2232,7 @@ class ZoneManager:
     #end region
 
     async def prepare_init_task(self, curr_zone: Zone,curr_subzone:Zone ,robot_id:int):
-        post_tasks=[]
+        reset_door=False
         if curr_zone.zone_id == 8: #for sysmex if job is loading , init is start job only
             if curr_subzone.is_loading():
                 curr_subzone.progress_phase()
@@ -1766,10 +2240,9 @@ class ZoneManager:
             elif curr_subzone.is_in_phase([ZonePhase.READY_TO_START,ZonePhase.IN_PROCESS,ZonePhase.READY_TO_STOP]) :
                 return False
             else:
-                post_tasks= [lambda:curr_subzone.set_door(False),
-                             lambda: curr_subzone.set_zone_phase(ZonePhase.PRE_PROCESS)]            
+                reset_door=True
         
-        random_id= randint(1000000, 9999999)
+        random_id= futures_manager.next_id()
         result = ResponseData(
             curr_zone=curr_zone.zone_id, 
             curr_subzone=curr_subzone.zone_id if curr_subzone else 0,
@@ -1777,9 +2250,8 @@ class ZoneManager:
             random_id=random_id
             )   
         zone=curr_subzone or curr_zone  
-        post_tasks.append(lambda:zone.initialize())
-        futures_manager.register_future(random_id,post_tasks)
-        tasks_q[robot_id].append(result)
+        futures_manager.register_future(random_id,[FutureCommand("init_zone",{"zone":self.get_zone_path(zone),"reset_door":reset_door})])
+        tasks_q[robot_id].put(result,TaskPriority.INIT)
         return True
     
     async def prepare_init_tasks(self,robot_id):
@@ -1828,8 +2300,7 @@ class ZoneManager:
                             transits=transits
                         )
                     item=controls_zone.set_item(idx,vial)
-                    item.color=vial.color
-                    item.types=[vial.type]
+                    item.set_slot(vial.color,[vial.type])
                     vial_manager.add_vial(vial)
                 await self.export_data(None,None,None,None) 
                 tasks_auditor.info(f"Controls added successfully") 
@@ -1932,6 +2403,7 @@ class ZoneManager:
     async def zone_reset(self, transition: ZoneTransition, curr_zone: Zone, next_zone: Zone, robot_id:int):
         next_zone.set_zone_phase(ZonePhase.READAY_TO_PROCESS)
     
+    @time_dependent
     async def can_pick_vial(self, transition: ZoneTransition, curr_zone: Zone, next_zone: Zone, robot_id:int):
         zone_id= self.get_zone_by_color(transition.colors)  
         now = datetime.now().time()
@@ -1954,6 +2426,7 @@ class ZoneManager:
                 return False
         return True
     
+    @time_dependent
     def is_not_down_time(self, transition: ZoneTransition, curr_zone: Zone, next_zone: Zone, robot_id:int):
         now = datetime.now().time()
         start = time(1, 30)